@@ -3,7 +3,9 @@ import rapidsms
 import datetime
 
 from rapidsms.apps.base import AppBase
-from .models import Poll
+from rapidsms.models import Contact
+from .models import Poll, Response
+from django.db import transaction
 from django.db.models import Q
 from rapidsms_httprouter.models import Message, MessageBatch
 
@@ -12,6 +14,15 @@ import logging
 log = logging.getLogger(__name__)
 
 
+def lock_contact(contact):
+    """
+    Locks the contact's row for the rest of the transaction (where the
+    database supports SELECT ... FOR UPDATE), serializing the handling of
+    their messages without holding up anyone else's.
+    """
+    list(Contact.objects.select_for_update().filter(pk=contact.pk).values_list('pk', flat=True))
+
+
 class App(AppBase):
     def respond_to_message(self, message, response_msg, poll):
 
@@ -29,6 +40,60 @@ class App(AppBase):
             message.respond(response_msg)
 
 
+    def mark_handled(self, message):
+        if hasattr(message, 'db_message'):
+            # if no other app handles this message, we want
+            # the handled_by field set appropriately,
+            # it won't since this app returns false
+            db_message = message.db_message
+            db_message.handled_by = 'poll'
+            # one column, written without re-saving the whole message
+            Message.objects.filter(pk=db_message.pk).update(handled_by='poll')
+
+    def handle_response(self, message, poll):
+        contact = message.connection.contact
+        # held until the transaction ends, so that of two messages from the
+        # contact arriving together the second sees the first's response:
+        # a one-response poll's is replaced rather than both being kept (or
+        # both deleted), and a replayed message is recognised
+        lock_contact(contact)
+
+        if message.db_message.pk and Response.objects.filter(message=message.db_message).exists():
+            log.debug("[poll-app] Message already has a response, ignoring the replay")
+            return
+
+        old_responses = list(poll.responses.filter(contact=contact))
+        if old_responses:
+            log.debug("[poll-app] Processing response again (theres already one from this contact)")
+            response_obj, response_msg = poll.process_response(message)
+            if poll.response_type == Poll.RESPONSE_TYPE_ONE:
+                log.debug(
+                    "[poll-app] Poll only allows one response per person, overwriting old response "
+                    "and replying...")
+                # a replay that slipped past the check above comes back as the existing response
+                old_responses = [old for old in old_responses if old.pk != response_obj.pk]
+                if not response_obj.has_errors or all(old.has_errors for old in old_responses):
+                    for old_response in old_responses:
+                        old_response.delete()
+                    self.mark_handled(message)
+                    if response_msg and response_msg.strip():
+                        self.respond_to_message(message, response_msg, poll)
+                else:
+                    response_obj.delete()
+            else:
+                log.debug("[poll-app] Recorded response but NOT sending the response message")
+
+        else:
+            log.debug("[poll-app] Processing message and replying to sender...")
+            response_obj, response_msg = poll.process_response(message)
+            self.mark_handled(message)
+            if response_msg and response_msg.strip():
+                self.respond_to_message(message, response_msg, poll)
+            elif poll.default_response:
+                #send default response anyway even for errors
+                self.respond_to_message(message, poll.default_response, poll)
+        log.debug("[poll-app] Message handled.")
+
     def handle(self, message):
         # see if this contact matches any of our polls
         if message.connection is not None and message.db_message.pk:
@@ -46,50 +111,9 @@ class App(AppBase):
 
                 log.debug("[poll-app] Found poll for message [{}]".format(unicode(poll)))
 
-                if poll.responses.filter(contact=message.connection.contact).exists():
-                    old_response = poll.responses.filter(contact=message.connection.contact)[0]
-                    log.debug("[poll-app] Processing response again (theres already one from this contact)")
-                    response_obj, response_msg = poll.process_response(message)
-                    if poll.response_type == Poll.RESPONSE_TYPE_ONE:
-                        log.debug(
-                            "[poll-app] Poll only allows one response per person, overwriting old response "
-                            "and replying...")
-                        if not response_obj.has_errors or old_response.has_errors:
-                            old_response.delete()
-                            if hasattr(message, 'db_message'):
-                                db_message = message.db_message
-                                db_message.handled_by = 'poll'
-                                db_message.save()
-                            if response_msg and response_msg.strip():
-                                self.respond_to_message(message, response_msg, poll)
-                        else:
-                            response_obj.delete()
-                        log.debug("[poll-app] Message handled.")
-                        return False
-                    else:
-                        log.debug("[poll-app] Recorded response but NOT sending the response message")
-                        log.debug("[poll-app] Message handled.")
-                        return False
-
-                else:
-                    log.debug("[poll-app] Processing message and replying to sender...")
-                    response_obj, response_msg = poll.process_response(message)
-                    if hasattr(message, 'db_message'):
-                        # if no other app handles this message, we want
-                        # the handled_by field set appropriately,
-                        # it won't since this app returns false
-                        db_message = message.db_message
-                        db_message.handled_by = 'poll'
-                        db_message.save()
-                    if response_msg and response_msg.strip():
-                        self.respond_to_message(message, response_msg, poll)
-                    elif poll.default_response:
-                        #send default response anyway even for errors
-                        self.respond_to_message(message, poll.default_response, poll)
-
-                    log.debug("[poll-app] Message handled.")
-                    # play nice, let other things handle responses
-                    return False
+                transaction.commit_on_success(self.handle_response)(message, poll)
+                # play nice, let other things handle responses
+                return False
             except Poll.DoesNotExist:
                 if message.connection is not None:
                     log.debug("[poll-app] [%s] Poll not found for this message" % message.connection.identity)
@@ -97,4 +121,4 @@ class App(AppBase):
                     log.debug("[poll-app] Poll not found for this message, and there is no connection either")
                 pass
             log.debug("[poll-app] Handled.")
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,52 @@
+"""
+HyperLogLog helpers for estimating distinct responders.  A sketch is a set
+of registers, each holding the highest rank seen among the items hashed to
+it; sketches merge by taking the maximum of each register, so they can be
+stored as rows and combined with a grouped MAX() in SQL.
+"""
+import hashlib
+import math
+import struct
+
+# 2 ** 14 registers for a poll's sketches, for a standard error of
+# 1.04 / sqrt(2 ** 14) ~= 0.8%
+PRECISION = 14
+# 2 ** 10 registers for each location's, ~3.3%, so that a location's sketch
+# is at most 1024 rows however many respond there
+LOCATION_PRECISION = 10
+
+
+def standard_error(precision=PRECISION):
+    """
+    Returns the relative standard error of a sketch's estimates.
+    """
+    return 1.04 / math.sqrt(1 << precision)
+
+
+def sketch_position(item, precision=PRECISION):
+    """
+    Returns the (register, rank) an item sets in a sketch.
+    """
+    value = struct.unpack('>Q', hashlib.md5(str(item)).digest()[:8])[0]
+    rank_bits = 64 - precision
+    register = value >> rank_bits
+    rest = value & ((1 << rank_bits) - 1)
+    return register, rank_bits - rest.bit_length() + 1
+
+
+def estimate_cardinality(registers, precision=PRECISION):
+    """
+    Estimates the number of distinct items from a {register: rank} dict,
+    registers missing from the dict being empty.  Returns (estimate,
+    standard error), both as floats.
+    """
+    if not registers:
+        return 0.0, 0.0
+    size = 1 << precision
+    empty = size - len(registers)
+    total = empty + sum(2.0 ** -rank for rank in registers.itervalues())
+    estimate = 0.7213 / (1 + 1.079 / size) * size * size / total
+    if estimate <= 2.5 * size and empty:
+        # linear counting is more accurate while many registers are empty
+        estimate = size * math.log(float(size) / empty)
+    return estimate, estimate * standard_error(precision)
@@ -0,0 +1,237 @@
+import datetime
+import gzip
+import os
+
+from django.conf import settings
+from django.db import connection, router, transaction
+from django.db.models import sql
+from django.utils import simplejson
+
+from bulk_values import write_response_values
+from eav_ids import get_content_type_id
+from export import iter_response_chunks, get_chunk_categories, get_response_value
+from models import Poll, Response, ResponseCategory, ResultSnapshot, PollArchive, VALUE_ATTRIBUTES
+
+# polls that ended longer ago than this are moved out of the hot tables
+ARCHIVE_AFTER_DAYS = getattr(settings, 'POLL_ARCHIVE_AFTER_DAYS', 365)
+
+# number of responses written, deleted or restored per round trip (and
+# per transaction, when deleting or restoring)
+ARCHIVE_CHUNK_SIZE = getattr(settings, 'POLL_ARCHIVE_CHUNK_SIZE', 1000)
+
+# where archived responses are kept, one gzipped file per poll
+ARCHIVE_ROOT = getattr(settings, 'POLL_ARCHIVE_ROOT', os.path.join(settings.MEDIA_ROOT, 'poll_archives'))
+
+ARCHIVE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _format_date(date):
+    return date.strftime(ARCHIVE_DATE_FORMAT) if date else None
+
+
+def _parse_date(value):
+    return datetime.datetime.strptime(value, ARCHIVE_DATE_FORMAT) if value else None
+
+
+def polls_to_archive(days=ARCHIVE_AFTER_DAYS):
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    return Poll.objects.filter(end_date__lt=cutoff, archive=None).order_by('end_date')
+
+
+def iter_archive_records(poll, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Yields one dict per response holding both the rows needed to restore
+    it and the fields its export shows, which can't be looked up again
+    once the message and contact have moved on.
+    """
+    for chunk in iter_response_chunks(poll, chunk_size):
+        response_ids = [r.pk for r in chunk]
+        Response.prefetch_values(chunk)
+        names = get_chunk_categories(response_ids)
+        categories = {}
+        rows = ResponseCategory.objects.filter(response__in=response_ids).order_by('pk') \
+            .values_list('response', 'category', 'is_override', 'user')
+        for response_id, category_id, is_override, user_id in rows:
+            categories.setdefault(response_id, []).append([category_id, is_override, user_id])
+
+        for response in chunk:
+            message = response.message
+            sender = message_date = None
+            if message is not None:
+                contact = message.connection.contact
+                sender = unicode(contact) if contact else message.connection.identity
+                message_date = message.date
+            location_value = response.poll_location_value
+            yield {
+                'id': response.pk,
+                'message': response.message_id,
+                'contact': response.contact_id,
+                'location': response.location_id,
+                'date': _format_date(response.date),
+                'has_errors': response.has_errors,
+                'text_value': response.poll_text_value,
+                'number_value': response.poll_number_value,
+                'location_value': location_value.pk if location_value else None,
+                'categories': categories.get(response.pk, []),
+                'export': {
+                    'sender': sender,
+                    'date': _format_date(message_date),
+                    'value': get_response_value(poll.type, response),
+                    'categories': names.get(response.pk, []),
+                },
+            }
+
+
+def write_archive(poll, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Writes a poll's responses to a gzipped file of JSON lines under
+    ARCHIVE_ROOT, moved into place only when complete.  Returns the path,
+    the number of responses written and the highest response id written.
+    """
+    if not os.path.isdir(ARCHIVE_ROOT):
+        os.makedirs(ARCHIVE_ROOT)
+    path = os.path.join(ARCHIVE_ROOT, 'poll-%d.ndjson.gz' % poll.pk)
+    partial_path = path + '.part'
+
+    count, last_pk = 0, None
+    out = gzip.open(partial_path, 'wb')
+    try:
+        for record in iter_archive_records(poll, chunk_size):
+            out.write(simplejson.dumps(record) + '\n')
+            count += 1
+            if last_pk is None:
+                # responses are written newest first
+                last_pk = record['id']
+    finally:
+        out.close()
+    os.rename(partial_path, path)
+    return path, count, last_pk
+
+
+def read_archive(archive):
+    archived = gzip.open(archive.file_path, 'rb')
+    try:
+        for line in archived:
+            yield simplejson.loads(line)
+    finally:
+        archived.close()
+
+
+def iter_archived_export_records(archive):
+    """
+    Yields an archived poll's responses in the form iter_response_records
+    does for live ones.
+    """
+    for record in read_archive(archive):
+        export = record['export']
+        yield {
+            'id': record['id'],
+            'sender': export['sender'],
+            'date': _parse_date(export['date']),
+            'value': export['value'],
+            'categories': export['categories'],
+        }
+
+
+def delete_rows(table, column, ids, extra_where='', extra_params=()):
+    placeholders = ', '.join(['%s'] * len(ids))
+    connection.cursor().execute("DELETE FROM %s WHERE %s IN (%s)%s" % (table, column, placeholders, extra_where),
+                                list(ids) + list(extra_params))
+
+
+def delete_archived_responses(poll, last_pk, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Deletes a poll's responses up to last_pk, with their categories and
+    values, a chunk per transaction.  The rows are deleted in SQL so that
+    the counters, rollups and data version maintained by the signal
+    handlers keep describing the poll's (archived) responses.
+    """
+    while True:
+        ids = list(Response.objects.filter(poll=poll, pk__lte=last_pk).order_by('pk')
+                   .values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return
+
+        def delete_chunk():
+            delete_rows('eav_value', 'entity_id', ids, ' AND entity_ct_id = %s', [get_content_type_id(Response)])
+            delete_rows('poll_responsecategory', 'response_id', ids)
+            delete_rows('poll_response', 'id', ids)
+        transaction.commit_on_success(delete_chunk)()
+
+
+def archive_poll(poll, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Moves an ended poll's responses out of the hot tables into its archive
+    file.  Its results are snapshotted first, and the snapshot serves its
+    reports from then on.
+    """
+    if not poll.end_date:
+        raise ValueError("poll %d is still open" % poll.pk)
+    ResultSnapshot.build(poll)
+    path, count, last_pk = write_archive(poll, chunk_size)
+    archive, created = PollArchive.objects.get_or_create(poll=poll, defaults={'file_path': path})
+    archive.file_path = path
+    archive.response_count = count
+    archive.save()
+    if last_pk is not None:
+        delete_archived_responses(poll, last_pk, chunk_size)
+    return archive
+
+
+def _insert_raw(model, objs):
+    # bulk_create, but inserting the values as they are: it would give the
+    # responses today's date, being auto_now_add
+    query = sql.InsertQuery(model)
+    query.insert_values(model._meta.local_fields, objs, raw=True)
+    query.get_compiler(using=router.db_for_write(model)).execute_sql()
+
+
+def _restore_chunk(poll, records):
+    responses, categories, values = [], [], []
+    for record in records:
+        responses.append(Response(id=record['id'], poll=poll, message_id=record['message'],
+                                  contact_id=record['contact'], location_id=record['location'],
+                                  date=_parse_date(record['date']), has_errors=record['has_errors']))
+        for category_id, is_override, user_id in record['categories']:
+            categories.append(ResponseCategory(response_id=record['id'], category_id=category_id,
+                                               is_override=is_override, user_id=user_id))
+        for slug in VALUE_ATTRIBUTES:
+            value = record[slug[len('poll_'):]]
+            if value is not None:
+                values.append((record['id'], slug, value))
+
+    # these inserts send no signals, so the counters, rollups and sketches
+    # (which were never changed by archiving) stay as they are
+    _insert_raw(Response, responses)
+    ResponseCategory.objects.bulk_create(categories)
+    write_response_values(values, chunk_size=len(values) or 1)
+
+
+def restore_poll(poll, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Brings an archived poll's responses back into the hot tables with their
+    original ids, a chunk per transaction, and removes its archive.
+    """
+    archive = PollArchive.objects.get(poll=poll)
+
+    # a restore interrupted part way is resumed by skipping what's back
+    restored = set(Response.objects.filter(poll=poll).values_list('pk', flat=True))
+    chunk = []
+    for record in read_archive(archive):
+        if record['id'] in restored:
+            continue
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            transaction.commit_on_success(_restore_chunk)(poll, chunk)
+            chunk = []
+    if chunk:
+        transaction.commit_on_success(_restore_chunk)(poll, chunk)
+
+    remove_archive(archive)
+
+
+def remove_archive(archive):
+    path = archive.file_path
+    archive.delete()
+    if os.path.exists(path):
+        os.remove(path)
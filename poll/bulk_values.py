@@ -0,0 +1,111 @@
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.datastructures import SortedDict
+
+from eav.models import Value
+from rapidsms.contrib.locations.models import Location
+
+from eav_ids import get_attribute_slugs, get_content_type_id
+from models import Poll, Response, VALUE_ATTRIBUTES, VALUE_STORAGE, VALUE_STORAGE_EAV, VALUE_STORAGE_NATIVE, \
+    poll_data_changed
+
+# number of values written per transaction
+BULK_VALUE_CHUNK_SIZE = getattr(settings, 'POLL_BULK_VALUE_CHUNK_SIZE', 1000)
+
+# the eav Value column and native Response column holding each attribute
+VALUE_COLUMNS = {
+    'poll_text_value': ('value_text', 'text_value'),
+    'poll_number_value': ('value_float', 'number_value'),
+    'poll_location_value': ('generic_value_id', 'location_value_id'),
+}
+
+
+def _update_by_id(table, column, pairs):
+    """
+    Sets `column` to a different value on each of the rows in `pairs`
+    ([(id, value)]) with one UPDATE, plus one for the rows being cleared.
+    """
+    cleared = [pk for pk, value in pairs if value is None]
+    pairs = [(pk, value) for pk, value in pairs if value is not None]
+    cursor = connection.cursor()
+    if cleared:
+        cursor.execute("UPDATE %s SET %s = NULL WHERE id IN (%s)" % (table, column, ', '.join(['%s'] * len(cleared))),
+                       cleared)
+    if pairs:
+        cursor.execute("UPDATE %s SET %s = CASE id %s END WHERE id IN (%s)"
+                       % (table, column, ' '.join(['WHEN %s THEN %s'] * len(pairs)), ', '.join(['%s'] * len(pairs))),
+                       [param for pair in pairs for param in pair] + [pk for pk, value in pairs])
+
+
+def _write_chunk(chunk, attributes, entity_ct, location_ct):
+    # the last value given for a response's attribute wins
+    latest = SortedDict()
+    for response_id, slug, value in chunk:
+        if slug == 'poll_location_value':
+            value = getattr(value, 'pk', value)
+        if value == '':
+            value = None
+        latest[(getattr(response_id, 'pk', response_id), slug)] = value
+    response_ids = set(response_id for response_id, slug in latest)
+
+    if VALUE_STORAGE != VALUE_STORAGE_NATIVE:
+        existing = dict(((entity_id, attribute_id), pk) for pk, entity_id, attribute_id in Value.objects.filter(
+            entity_ct=entity_ct, entity_id__in=response_ids, attribute__in=attributes.values())
+            .values_list('pk', 'entity_id', 'attribute'))
+        new, updates, deleted = [], {}, []
+        for (response_id, slug), value in latest.items():
+            column = VALUE_COLUMNS[slug][0]
+            pk = existing.get((response_id, attributes[slug]))
+            if value is None:
+                # as eav does, a cleared value has no row
+                if pk:
+                    deleted.append(pk)
+            elif pk:
+                updates.setdefault(column, []).append((pk, value))
+            else:
+                fields = {column: value}
+                if slug == 'poll_location_value':
+                    fields['generic_value_ct_id'] = location_ct
+                new.append(Value(entity_ct_id=entity_ct, entity_id=response_id, attribute_id=attributes[slug],
+                                 **fields))
+        if deleted:
+            Value.objects.filter(pk__in=deleted).delete()
+        for column, pairs in updates.items():
+            _update_by_id('eav_value', column, pairs)
+        Value.objects.bulk_create(new)
+
+    if VALUE_STORAGE != VALUE_STORAGE_EAV:
+        updates = {}
+        for (response_id, slug), value in latest.items():
+            updates.setdefault(VALUE_COLUMNS[slug][1], []).append((response_id, value))
+        for column, pairs in updates.items():
+            _update_by_id('poll_response', column, pairs)
+
+    return set(Response.objects.filter(pk__in=response_ids).values_list('poll', flat=True).distinct().order_by())
+
+
+def write_response_values(values, chunk_size=BULK_VALUE_CHUNK_SIZE):
+    """
+    Writes many response values at once from (response, attribute slug,
+    value) tuples, responses given as instances or ids and locations as
+    Locations or ids.  Attributes and content types are resolved once, and
+    each chunk costs one query for the existing rows plus one statement per
+    kind of change, wherever POLL_VALUE_STORAGE keeps the values.  No
+    signals are sent: the affected polls' data versions are bumped instead.
+    """
+    # Value rows are written for this site's attribute of each slug, as eav does
+    attributes = dict((slug, pk) for pk, slug in get_attribute_slugs(*VALUE_ATTRIBUTES).items())
+    entity_ct = get_content_type_id(Response)
+    location_ct = get_content_type_id(Location)
+
+    poll_ids = set()
+    values = iter(values)
+    while True:
+        chunk = list(islice(values, chunk_size))
+        if not chunk:
+            break
+        poll_ids.update(transaction.commit_on_success(_write_chunk)(chunk, attributes, entity_ct, location_ct))
+    for poll in Poll.all_objects.filter(pk__in=poll_ids):
+        poll_data_changed(poll)
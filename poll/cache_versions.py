@@ -0,0 +1,39 @@
+"""
+Version counters kept in the shared cache.  Whatever a process builds from
+the database (a cached report, the location index, the eav ids) is tagged
+with the version it was built under and rebuilt once the version moves on;
+any process changing the underlying rows bumps it.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# a version should outlive anything built from it
+VERSION_TIMEOUT = getattr(settings, 'POLL_VERSION_TIMEOUT', 60 * 60 * 24 * 30)
+
+
+def _seed():
+    # seeded from the clock so that a key evicted from the cache never comes
+    # back with a value something built earlier (or an old ETag) could match
+    return int(time.time() * 1000000)
+
+
+def get_version(key, timeout=VERSION_TIMEOUT):
+    """
+    Returns the current version under key, or None when the cache doesn't
+    keep it (a dummy cache, or memcached being down), in which case nothing
+    built earlier can be known to be current and callers rebuild it.
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _seed(), timeout)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key, timeout=VERSION_TIMEOUT):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _seed(), timeout)
@@ -0,0 +1,310 @@
+import calendar
+import datetime
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from dateutil.relativedelta import relativedelta
+from eav.models import Value
+from rapidsms.contrib.locations.models import Location
+
+from eav_ids import get_attribute_ids, get_content_type_id
+from models import Response, ResponseCategory, VALUE_STORAGE, VALUE_STORAGE_NATIVE
+from report_cache import get_data_version
+
+# how many polls' columns a process keeps loaded at once
+COLUMNAR_CACHE_SIZE = getattr(settings, 'POLL_COLUMNAR_CACHE_SIZE', 4)
+
+# gender codes; anything else (including no contact) is 0
+GENDERS = ['', 'M', 'F']
+
+MISSING = -1
+
+
+def _missing(length):
+    column = numpy.empty(length, dtype=numpy.int64)
+    column.fill(MISSING)
+    return column
+
+
+def _timestamp(date):
+    return calendar.timegm(date.timetuple())
+
+
+def _group_aggregates(groups, values):
+    """
+    Returns (group ids, count, sum, avg, population stddev, max, min) for
+    `values` grouped by the parallel array `groups`, one entry per group
+    that has any values.
+    """
+    order = numpy.argsort(groups, kind='mergesort')
+    groups, values = groups[order], values[order]
+    starts = numpy.flatnonzero(numpy.r_[True, groups[1:] != groups[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(values)])
+    sums = numpy.add.reduceat(values, starts)
+    avgs = sums / counts
+    deviations = values - numpy.repeat(avgs, counts)
+    stddevs = numpy.sqrt(numpy.add.reduceat(deviations * deviations, starts) / counts)
+    return (groups[starts], counts, sums, avgs, stddevs,
+            numpy.maximum.reduceat(values, starts), numpy.minimum.reduceat(values, starts))
+
+
+class ResponseColumns(object):
+    """
+    A poll's responses materialized as parallel NumPy arrays, one entry per
+    response in pk order, so the report functions can be answered with
+    vectorized group-bys instead of SQL over the EAV tables:
+
+    pk, contact, date (epoch seconds), location (where the contact was
+    when they answered), location_tree / location_lft (its nested-set position),
+    gender (a GENDERS code), birthdate (epoch seconds, see has_birthdate)
+    and value (the numeric answer, NaN if none).  Categorizations are a
+    second pair of arrays: rc_row (the response's row) and rc_category (an
+    index into categories, a list of (pk, name, color) by name).
+    """
+
+    def __init__(self, poll):
+        if numpy is None:
+            raise ImproperlyConfigured("The columnar report engine requires numpy")
+        self.poll = poll
+        # taken before loading, so changes made meanwhile make these stale
+        self.version = get_data_version(poll.pk)
+
+        columns = ([], [], [], [], [], [], [])
+        rows = poll.responses.order_by('pk').values_list(
+            'pk', 'contact', 'date', 'location', 'contact__gender', 'contact__birthdate')
+        for pk, contact, date, location, gender, birthdate in rows.iterator():
+            columns[0].append(pk)
+            columns[1].append(MISSING if contact is None else contact)
+            columns[2].append(_timestamp(date))
+            columns[3].append(MISSING if location is None else location)
+            columns[4].append(GENDERS.index(gender.upper()) if gender and gender.upper() in GENDERS else 0)
+            columns[5].append(0 if birthdate is None else _timestamp(birthdate))
+            columns[6].append(birthdate is not None)
+
+        self.pk = numpy.array(columns[0], dtype=numpy.int64)
+        self.contact = numpy.array(columns[1], dtype=numpy.int64)
+        self.date = numpy.array(columns[2], dtype=numpy.int64)
+        self.location = numpy.array(columns[3], dtype=numpy.int64)
+        self.gender = numpy.array(columns[4], dtype=numpy.int8)
+        self.birthdate = numpy.array(columns[5], dtype=numpy.int64)
+        self.has_birthdate = numpy.array(columns[6], dtype=bool)
+        self._load_locations()
+        self._load_categories()
+        self._load_values()
+
+    def __len__(self):
+        return len(self.pk)
+
+    def _rows_for(self, response_pks):
+        """
+        Maps response pks to row indexes, with -1 for responses not loaded.
+        """
+        response_pks = numpy.asarray(response_pks, dtype=numpy.int64)
+        if not len(self.pk):
+            return _missing(len(response_pks))
+        rows = numpy.searchsorted(self.pk, response_pks)
+        found = (rows < len(self.pk)) & (self.pk[numpy.minimum(rows, len(self.pk) - 1)] == response_pks)
+        return numpy.where(found, rows, MISSING)
+
+    def _load_locations(self):
+        self.location_tree = _missing(len(self))
+        self.location_lft = _missing(len(self))
+        located = numpy.unique(self.location[self.location != MISSING])
+        if not len(located):
+            return
+        positions = Location.objects.filter(pk__in=located.tolist()).order_by('pk') \
+            .values_list('pk', 'tree_id', 'lft')
+        if not positions:
+            return
+        pks, trees, lfts = [numpy.array(c, dtype=numpy.int64) for c in zip(*positions)]
+        index = numpy.searchsorted(pks, self.location)
+        index = numpy.minimum(index, len(pks) - 1)
+        known = (self.location != MISSING) & (pks[index] == self.location)
+        self.location_tree = numpy.where(known, trees[index], MISSING)
+        self.location_lft = numpy.where(known, lfts[index], MISSING)
+
+    def _load_categories(self):
+        self.categories = list(self.poll.categories.filter(deleted=False).order_by('name')
+                               .values_list('pk', 'name', 'color'))
+        category_pks = numpy.array([pk for pk, name, color in self.categories], dtype=numpy.int64)
+        order = numpy.argsort(category_pks)
+
+        pairs = ResponseCategory.objects.filter(response__poll=self.poll, category__deleted=False) \
+            .values_list('response', 'category')
+        responses, categories = [numpy.array(c, dtype=numpy.int64) for c in zip(*pairs)] \
+            or (numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64))
+        rows = self._rows_for(responses)
+        codes = order[numpy.searchsorted(category_pks[order], categories)] if len(categories) \
+            else categories
+        loaded = rows != MISSING
+        self.rc_row = rows[loaded]
+        self.rc_category = codes[loaded]
+
+    def _load_values(self):
+        self.value = numpy.empty(len(self))
+        self.value.fill(numpy.nan)
+        if VALUE_STORAGE == VALUE_STORAGE_NATIVE:
+            pairs = self.poll.responses.values_list('pk', 'number_value')
+        else:
+            pairs = Value.objects.filter(attribute__in=get_attribute_ids('poll_number_value'),
+                                         entity_ct=get_content_type_id(Response),
+                                         entity_id__in=self.poll.responses.all()) \
+                .values_list('entity_id', 'value_float')
+        pairs = [(entity_id, value) for entity_id, value in pairs if value is not None]
+        if pairs:
+            entity_ids, values = zip(*pairs)
+            rows = self._rows_for(entity_ids)
+            loaded = rows != MISSING
+            self.value[rows[loaded]] = numpy.array(values, dtype=numpy.float64)[loaded]
+
+    def place(self, locations):
+        """
+        Vectorized ancestor lookup: returns, for every response, the index
+        in `locations` of the location containing the respondent's
+        reporting location, or -1.  The locations mustn't nest.
+        """
+        placed = _missing(len(self))
+        if not locations or not len(self):
+            return placed
+        scale = max(max(l.rght for l in locations), self.location_lft.max()) + 1
+        order = sorted(range(len(locations)), key=lambda i: (locations[i].tree_id, locations[i].lft))
+        starts = numpy.array([locations[i].tree_id * scale + locations[i].lft for i in order], dtype=numpy.int64)
+        ends = numpy.array([locations[i].tree_id * scale + locations[i].rght for i in order], dtype=numpy.int64)
+        order = numpy.array(order, dtype=numpy.int64)
+
+        keys = self.location_tree * scale + self.location_lft
+        position = numpy.searchsorted(starts, keys, side='right') - 1
+        clipped = numpy.maximum(position, 0)
+        inside = (self.location_lft != MISSING) & (position >= 0) & (keys <= ends[clipped])
+        placed[inside] = order[clipped[inside]]
+        return placed
+
+    def count_by_category(self, groups=None, ngroups=1, rows=None):
+        """
+        Counts categorizations as an (ngroups x categories) matrix, grouping
+        responses by the parallel array `groups` (-1 to leave a response
+        out) and optionally restricting to the boolean row mask `rows`.
+        """
+        ncategories = len(self.categories)
+        if groups is None:
+            groups = numpy.zeros(len(self), dtype=numpy.int64)
+        if rows is not None:
+            groups = numpy.where(rows, groups, MISSING)
+        rc_groups = groups[self.rc_row]
+        counted = rc_groups != MISSING
+        cells = rc_groups[counted] * ncategories + self.rc_category[counted]
+        return numpy.bincount(cells, minlength=ngroups * ncategories)[:ngroups * ncategories] \
+            .reshape(ngroups, ncategories)
+
+    def count_uncategorized(self, groups=None, ngroups=1):
+        if groups is None:
+            groups = numpy.zeros(len(self), dtype=numpy.int64)
+        categorized = numpy.zeros(len(self), dtype=bool)
+        categorized[self.rc_row] = True
+        counted = (groups != MISSING) & ~categorized
+        return numpy.bincount(groups[counted], minlength=ngroups)[:ngroups]
+
+    def _report_locations(self, location, for_map):
+        locations = Location.objects.filter(pk__in=self.poll._report_location_ids(location))
+        if for_map:
+            locations = locations.exclude(point=None).select_related('point')
+        return sorted(locations, key=lambda l: l.name)
+
+    def responses_by_category(self, location=None, for_map=True):
+        if location is None:
+            counts = self.count_by_category()[0]
+            rows = [{'category__name': name, 'category__color': color, 'value': int(count)}
+                    for (pk, name, color), count in zip(self.categories, counts) if count]
+            uncategorized = int(self.count_uncategorized()[0])
+            if uncategorized:
+                rows.append({'poll__pk': self.poll.pk, 'category__name': 'uncategorized',
+                             'category__color': '', 'value': uncategorized})
+            return rows
+
+        locations = self._report_locations(location, for_map)
+        groups = self.place(locations)
+        counts = self.count_by_category(groups, len(locations))
+        uncategorized = self.count_uncategorized(groups, len(locations))
+        rows = []
+        for index, l in enumerate(locations):
+            cells = [(name, color, int(count)) for (pk, name, color), count in zip(self.categories, counts[index])]
+            if uncategorized[index]:
+                cells.append(('uncategorized', '', int(uncategorized[index])))
+            for name, color, count in cells:
+                if not count:
+                    continue
+                row = {'location_name': l.name, 'location_id': l.pk,
+                       'category__name': name, 'category__color': color, 'value': count}
+                if for_map:
+                    row['lat'] = '%.5f' % float(l.point.latitude)
+                    row['lon'] = '%.5f' % float(l.point.longitude)
+                rows.append(row)
+        return rows
+
+    def get_numeric_report_data(self, location=None, for_map=None):
+        answered = ~numpy.isnan(self.value)
+        if location is None:
+            groups = numpy.zeros(len(self), dtype=numpy.int64)
+            labels = [{'entity_ct': get_content_type_id(Response)}]
+        else:
+            locations = self._report_locations(location, False)
+            groups = self.place(locations)
+            labels = [{'location_name': l.name, 'location_id': l.pk} for l in locations]
+        answered &= groups != MISSING
+        if not answered.any():
+            return []
+
+        rows = []
+        for group, count, total, avg, stddev, maximum, minimum in zip(
+                *_group_aggregates(groups[answered], self.value[answered])):
+            row = dict(labels[group])
+            row.update({
+                'value_float__count': int(count),
+                'value_float__sum': float(total),
+                'value_float__avg': float(avg),
+                'value_float__stddev': float(stddev),
+                'value_float__max': float(maximum),
+                'value_float__min': float(minimum),
+            })
+            rows.append(row)
+        return sorted(rows, key=lambda r: r.get('location_name'))
+
+    def _category_counts(self, rows):
+        counts = self.count_by_category(rows=rows)[0]
+        return [[int(count), name] for (pk, name, color), count in zip(self.categories, counts) if count]
+
+    def responses_by_age(self, lower_bound_in_years, upper_bound_in_years):
+        now = datetime.datetime.now()
+        youngest = _timestamp(now - relativedelta(years=lower_bound_in_years))
+        oldest = _timestamp(now - relativedelta(years=upper_bound_in_years))
+        return self._category_counts(self.has_birthdate & (self.birthdate >= oldest) & (self.birthdate <= youngest))
+
+    def responses_by_gender(self, gender):
+        code = GENDERS.index(gender.upper()) if gender.upper() in GENDERS[1:] else None
+        return self._category_counts(self.gender == code) if code is not None else []
+
+
+_loaded = OrderedDict()
+
+
+def load_columns(poll):
+    """
+    Returns the poll's ResponseColumns, reusing the ones this process
+    loaded last unless the poll's data version has moved on since.
+    """
+    if poll.is_archived():
+        raise ValueError("poll %d is archived" % poll.pk)
+    version = get_data_version(poll.pk)
+    columns = _loaded.pop(poll.pk, None)
+    if columns is None or version is None or columns.version != version:
+        columns = ResponseColumns(poll)
+    _loaded[poll.pk] = columns
+    while len(_loaded) > COLUMNAR_CACHE_SIZE:
+        _loaded.popitem(last=False)
+    return columns
@@ -0,0 +1,63 @@
+"""
+The ids the eav queries filter on, cached in-process so that they compare
+integer columns instead of joining eav_attribute by slug or looking up
+content types.  Only the current site's attributes are used, as eav itself
+and the bulk value writes do.  The ids are loaded on first use rather than
+at startup, when the attributes may not have been created yet, and again
+whenever any process has changed an Attribute since.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete
+
+from eav.models import Attribute
+
+from cache_versions import get_version, bump_version
+
+EAV_IDS_VERSION_KEY = 'poll:eav_ids_version'
+
+_attribute_ids = None
+_attribute_ids_version = None
+_content_type_ids = {}
+
+
+def warm_eav_ids(version):
+    global _attribute_ids, _attribute_ids_version
+    attribute_ids = {}
+    for pk, slug in Attribute.on_site.order_by('pk').values_list('pk', 'slug'):
+        attribute_ids.setdefault(slug, []).append(pk)
+    _attribute_ids, _attribute_ids_version = attribute_ids, version
+
+
+def get_attribute_ids(*slugs):
+    """
+    Returns the ids of the current site's attributes with the given slugs;
+    a slug the site has no attribute for has none until one is created.
+    The check that the ids are still current is one cache lookup.
+    """
+    version = get_version(EAV_IDS_VERSION_KEY)
+    if _attribute_ids is None or version is None or _attribute_ids_version != version:
+        warm_eav_ids(version)
+    return [pk for slug in slugs for pk in _attribute_ids.get(slug, [])]
+
+
+def get_attribute_slugs(*slugs):
+    """
+    Returns {attribute id: slug} for the attributes with the given slugs.
+    """
+    get_attribute_ids(*slugs)
+    return dict((pk, slug) for slug in slugs for pk in _attribute_ids.get(slug, []))
+
+
+def get_content_type_id(model):
+    if model not in _content_type_ids:
+        _content_type_ids[model] = ContentType.objects.get_for_model(model).pk
+    return _content_type_ids[model]
+
+
+def invalidate_eav_ids(sender, **kwargs):
+    global _attribute_ids
+    _attribute_ids = None
+    bump_version(EAV_IDS_VERSION_KEY)
+
+post_save.connect(invalidate_eav_ids, sender=Attribute)
+post_delete.connect(invalidate_eav_ids, sender=Attribute)
@@ -0,0 +1,176 @@
+import csv
+import gzip
+import os
+
+from django.conf import settings
+from django.utils import simplejson
+
+from models import Poll, Response, ResponseCategory, ExportJob, PollArchive
+
+# number of responses fetched (and held in memory) per round trip
+EXPORT_CHUNK_SIZE = getattr(settings, 'POLL_EXPORT_CHUNK_SIZE', 1000)
+
+# where background export jobs write their artifacts
+EXPORT_ROOT = getattr(settings, 'POLL_EXPORT_ROOT', os.path.join(settings.MEDIA_ROOT, 'poll_exports'))
+
+CSV_HEADER = ['sender', 'time', 'value', 'categories']
+
+
+def iter_response_chunks(poll, chunk_size=EXPORT_CHUNK_SIZE, using=None):
+    """
+    Walks a poll's responses newest first, one keyset-paginated chunk at a
+    time, so that a large poll is never loaded in full.  Each chunk is a
+    single query joined against message, connection and contact.
+    """
+    last_pk = None
+    while True:
+        responses = poll.responses.select_related('message__connection__contact').order_by('-pk')
+        if using:
+            responses = responses.using(using)
+        if last_pk is not None:
+            responses = responses.filter(pk__lt=last_pk)
+        chunk = list(responses[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def get_chunk_categories(response_ids, using=None):
+    """
+    Returns {response_id: [category names]} for a chunk of responses.
+    """
+    categories = {}
+    rows = ResponseCategory.objects.db_manager(using).filter(response__in=response_ids) \
+        .order_by('pk').values_list('response', 'category__name')
+    for response_id, name in rows:
+        categories.setdefault(response_id, []).append(name)
+    return categories
+
+
+def get_response_value(poll_type, response):
+    if poll_type == Poll.TYPE_TEXT:
+        return response.poll_text_value
+    elif poll_type == Poll.TYPE_NUMERIC:
+        return response.poll_number_value
+    elif poll_type == Poll.TYPE_LOCATION and response.poll_location_value:
+        return response.poll_location_value.name
+    return None
+
+
+def iter_response_records(poll, chunk_size=EXPORT_CHUNK_SIZE, using=None):
+    """
+    Yields one dict per response with everything an export needs, using
+    a constant number of queries per chunk.  An archived poll's come
+    from its archive file.
+    """
+    try:
+        archive = poll.archive
+    except PollArchive.DoesNotExist:
+        archive = None
+    if archive is not None:
+        from archive import iter_archived_export_records
+        for record in iter_archived_export_records(archive):
+            yield record
+        return
+
+    for chunk in iter_response_chunks(poll, chunk_size, using):
+        response_ids = [r.pk for r in chunk]
+        Response.prefetch_values(chunk, using)
+        categories = get_chunk_categories(response_ids, using)
+        for response in chunk:
+            message = response.message
+            sender = date = None
+            if message is not None:
+                contact = message.connection.contact
+                sender = unicode(contact) if contact else message.connection.identity
+                date = message.date
+            yield {
+                'id': response.pk,
+                'sender': sender,
+                'date': date,
+                'value': get_response_value(poll.type, response),
+                'categories': categories.get(response.pk, []),
+            }
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+
+def iter_csv_rows(poll, chunk_size=EXPORT_CHUNK_SIZE, using=None):
+    """
+    Yields the rows of the poll's csv export as lists of utf-8 encoded
+    strings, in the same layout as polls/responses.csv.
+    """
+    for record in iter_response_records(poll, chunk_size, using):
+        yield [
+            _encode(record['sender']),
+            record['date'].strftime('%d/%m/%Y %H:%M') if record['date'] else '',
+            _encode(record['value']),
+            ''.join(['%s,' % _encode(name) for name in record['categories']]),
+        ]
+
+
+class Echo(object):
+    """
+    A file-like object whose write() hands the line back, so csv.writer
+    can be used to format lines for a streaming response.
+    """
+    def write(self, value):
+        return value
+
+
+def stream_csv(poll, chunk_size=EXPORT_CHUNK_SIZE, header=True, using=None):
+    writer = csv.writer(Echo(), quoting=csv.QUOTE_ALL)
+    if header:
+        yield writer.writerow(CSV_HEADER)
+    for row in iter_csv_rows(poll, chunk_size, using):
+        yield writer.writerow(row)
+
+
+def iter_ndjson_lines(poll, chunk_size=EXPORT_CHUNK_SIZE):
+    for record in iter_response_records(poll, chunk_size):
+        if record['date']:
+            record['date'] = record['date'].isoformat()
+        yield simplejson.dumps(record) + '\n'
+
+
+def write_export(job, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Writes the export for an ExportJob as a gzip-compressed file under
+    EXPORT_ROOT, recording progress on the job after every chunk and on the
+    job instance as it goes, so a failed job saves how far it got.  The file
+    is written under a temporary name and moved into place when complete,
+    so a finished path never points to a partial export.
+    """
+    if not os.path.isdir(EXPORT_ROOT):
+        os.makedirs(EXPORT_ROOT)
+    path = os.path.join(EXPORT_ROOT, 'poll-%d-export-%d.%s.gz' % (job.poll_id, job.pk, job.format))
+    partial_path = path + '.part'
+
+    out = gzip.open(partial_path, 'wb')
+    try:
+        try:
+            if job.format == ExportJob.FORMAT_NDJSON:
+                lines = iter_ndjson_lines(job.poll, chunk_size)
+            else:
+                out.write(csv.writer(Echo(), quoting=csv.QUOTE_ALL).writerow(CSV_HEADER))
+                lines = stream_csv(job.poll, chunk_size, header=False)
+
+            job.rows_written = 0
+            for line in lines:
+                out.write(line)
+                job.rows_written += 1
+                if job.rows_written % chunk_size == 0:
+                    ExportJob.objects.filter(pk=job.pk).update(rows_written=job.rows_written)
+        finally:
+            out.close()
+    except Exception:
+        # a failed job leaves nothing behind
+        os.remove(partial_path)
+        raise
+    os.rename(partial_path, path)
+    return path
@@ -68,7 +68,7 @@ class PollTranslation(forms.ModelForm):
 class EditPollForm(forms.ModelForm): # pragma: no cover
     class Meta:
         model = Poll
-        fields = ('name', 'default_response')
+        fields = ('name', 'default_response', 'approximate_reports')
 
     def clean(self):
         cleaned_data = self.cleaned_data
@@ -0,0 +1,109 @@
+import bisect
+from collections import namedtuple
+
+from django.db.models.signals import post_save, post_delete
+
+from rapidsms.contrib.locations.models import Location
+
+from cache_versions import get_version, bump_version
+
+LOCATION_TREE_VERSION_KEY = 'poll:location_tree_version'
+
+Node = namedtuple('Node', 'pk name tree_id lft rght level')
+
+
+def location_placer(locations):
+    """
+    Returns a function mapping a nested-set position (tree_id, lft) to the
+    index of the location in `locations` that contains it, or None, using a
+    binary search over the locations' bounds.  The locations mustn't nest.
+    """
+    bounds = sorted((l.tree_id, l.lft, l.rght, index) for index, l in enumerate(locations))
+    starts = [(tree_id, lft) for tree_id, lft, rght, index in bounds]
+
+    def place(tree_id, lft):
+        if lft is None:
+            return None
+        position = bisect.bisect_right(starts, (tree_id, lft)) - 1
+        if position >= 0:
+            b_tree_id, b_lft, b_rght, index = bounds[position]
+            if b_tree_id == tree_id and lft <= b_rght:
+                return index
+        return None
+    return place
+
+
+class LocationIndex(object):
+    """
+    The whole locations tree as nodes sorted by (tree_id, lft), with the
+    nodes of each level kept apart, so that children and ancestors can be
+    found by binary search instead of a query per lookup.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.nodes = [Node(*row) for row in Location.objects.order_by('tree_id', 'lft')
+                      .values_list('pk', 'name', 'tree_id', 'lft', 'rght', 'level')]
+        self.by_pk = dict((node.pk, node) for node in self.nodes)
+        self.levels = {}
+        for node in self.nodes:
+            self.levels.setdefault(node.level, []).append(node)
+        self._level_starts = dict((level, [(n.tree_id, n.lft) for n in nodes])
+                                  for level, nodes in self.levels.items())
+        self._placers = {}
+
+    def at_level(self, level):
+        return self.levels.get(level, [])
+
+    def children(self, pk):
+        """
+        The direct children of a location, in tree order.
+        """
+        node = self.by_pk[pk]
+        nodes = self.at_level(node.level + 1)
+        starts = self._level_starts.get(node.level + 1, [])
+        first = bisect.bisect_left(starts, (node.tree_id, node.lft))
+        last = bisect.bisect_right(starts, (node.tree_id, node.rght))
+        return nodes[first:last]
+
+    def level_placer(self, level):
+        if level not in self._placers:
+            self._placers[level] = location_placer(self.at_level(level))
+        return self._placers[level]
+
+    def ancestor_at_level(self, pk, level):
+        """
+        Returns the node at `level` containing the location `pk` (the
+        location itself if it is at that level), or None.
+        """
+        node = self.by_pk.get(pk)
+        if node is None or node.level < level:
+            return None
+        index = self.level_placer(level)(node.tree_id, node.lft)
+        if index is None:
+            return None
+        return self.levels[level][index]
+
+
+_index = None
+
+
+def get_location_index():
+    """
+    Returns this process's LocationIndex, rebuilt whenever any process has
+    changed a location since it was built.  The check is one cache lookup.
+    """
+    global _index
+    version = get_version(LOCATION_TREE_VERSION_KEY)
+    if _index is None or version is None or _index.version != version:
+        _index = LocationIndex(version)
+    return _index
+
+
+def invalidate_location_index(sender, **kwargs):
+    global _index
+    _index = None
+    bump_version(LOCATION_TREE_VERSION_KEY)
+
+post_save.connect(invalidate_location_index, sender=Location)
+post_delete.connect(invalidate_location_index, sender=Location)
@@ -0,0 +1,28 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from poll.models import Poll
+from poll.archive import ARCHIVE_AFTER_DAYS, archive_poll, polls_to_archive
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = "Move the responses of polls that ended long ago out of the hot tables into archive files"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        make_option('-d', '--days', dest='days', type='int', default=ARCHIVE_AFTER_DAYS,
+                    help="archive polls that ended more than this many days ago"),
+        )
+
+    def handle(self, **options):
+        if options['p']:
+            polls = Poll.objects.filter(pk=int(options['p']))
+        else:
+            polls = polls_to_archive(options['days'])
+        for poll in polls:
+            archive = archive_poll(poll)
+            self.stdout.write("poll %d: %d responses archived to %s\n" % (poll.pk, archive.response_count,
+                                                                          archive.file_path))
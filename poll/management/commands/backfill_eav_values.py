@@ -0,0 +1,31 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from poll import models as poll_models
+from poll.models import Response
+from poll.bulk_values import write_response_values
+
+from optparse import make_option
+
+VALUE_COLUMNS = [('text_value', 'poll_text_value'), ('number_value', 'poll_number_value'),
+                 ('location_value', 'poll_location_value')]
+
+
+class Command(BaseCommand):
+    help = "Copy responses' native value columns into eav, for going back from POLL_VALUE_STORAGE 'native' " \
+           "to 'eav' (run it with 'dual', which writes both)"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        )
+
+    def handle(self, **options):
+        if poll_models.VALUE_STORAGE != poll_models.VALUE_STORAGE_DUAL:
+            raise CommandError("Set POLL_VALUE_STORAGE to 'dual' first")
+        responses = Response.objects.exclude(text_value=None, number_value=None, location_value=None)
+        if options['p']:
+            responses = responses.filter(poll=int(options['p']))
+        rows = responses.order_by('pk').values_list('pk', *[column for column, slug in VALUE_COLUMNS]).iterator()
+        write_response_values((row[0], slug, value) for row in rows
+                              for (column, slug), value in zip(VALUE_COLUMNS, row[1:]) if value is not None)
@@ -0,0 +1,27 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from poll.models import Poll, ResponseRollup, ResponderSketch
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = "Rebuild the hourly response rollups and responder sketches of one or all polls from their raw responses"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        )
+
+    def handle(self, **options):
+        polls = Poll.objects.order_by('pk')
+        if options['p']:
+            polls = polls.filter(pk=int(options['p']))
+        for poll in polls:
+            rebuild = transaction.commit_on_success(ResponseRollup.rebuild)
+            rows = rebuild(poll)
+            rebuild = transaction.commit_on_success(ResponderSketch.rebuild)
+            registers = rebuild(poll)
+            self.stdout.write("poll %d: %d rollup rows, %d sketch registers\n" % (poll.pk, rows, registers))
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from poll.models import Response
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = "Fill in the location of responses recorded before it was captured, from their contact's " \
+           "current reporting location (the best record left of where they answered from)"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        )
+
+    def handle(self, **options):
+        responses = Response.objects.filter(location=None).exclude(contact=None)
+        if options['p']:
+            responses = responses.filter(poll=int(options['p']))
+        location_ids = responses.exclude(contact__reporting_location=None) \
+            .values_list('contact__reporting_location', flat=True).distinct().order_by()
+        total = 0
+        for location_id in list(location_ids):
+            update = transaction.commit_on_success(
+                lambda: responses.filter(contact__reporting_location=location_id).update(location=location_id))
+            total += update()
+        self.stdout.write("%d responses located; run backfill_poll_rollups to regroup the rollups\n" % total)
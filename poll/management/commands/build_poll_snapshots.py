@@ -0,0 +1,33 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from poll.models import Poll, ResultSnapshot
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = "Build the frozen results snapshot of ended polls that have none or whose snapshot is out of date"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        make_option('-f', '--force', action='store_true', dest='force', default=False,
+                    help="Rebuild snapshots that are still current too"),
+        )
+
+    def handle(self, **options):
+        # an archived poll's snapshot is all that's left of its results
+        polls = Poll.objects.exclude(end_date=None).filter(archive=None).order_by('pk')
+        if options['p']:
+            polls = polls.filter(pk=int(options['p']))
+        current = set()
+        if not options['force']:
+            current = set(ResultSnapshot.objects.filter(poll__in=polls, changes=F('built_changes'))
+                          .values_list('poll', flat=True))
+        for poll in polls:
+            if poll.pk in current:
+                continue
+            snapshot = ResultSnapshot.build(poll)
+            self.stdout.write("poll %d: %d bytes\n" % (poll.pk, len(snapshot.results)))
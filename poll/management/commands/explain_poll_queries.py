@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Q
+
+from poll.models import Poll, ResponseCategory
+
+from optparse import make_option
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+class Command(BaseCommand):
+    help = "Print the database's plan for each of the poll app's hot queries, flagging any that " \
+           "doesn't use an index (run it against production-sized data: planners scan small tables)"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        make_option('-d', '--database', dest='database', default=DEFAULT_DB_ALIAS),
+        )
+
+    def hot_queries(self, poll):
+        response = poll.responses.exclude(contact=None).order_by('-pk')[:1]
+        response = response[0] if response else None
+        category = poll.categories.order_by('pk')[:1]
+        category = category[0] if category else None
+        contact_id = response.contact_id if response else 0
+        return [
+            ("open poll for a contact (App.handle)",
+             Poll.objects.filter(contacts=contact_id).exclude(start_date=None)
+             .filter(Q(end_date=None) | Q(end_date__gt=datetime.datetime.now())).order_by('-start_date')[:1]),
+            ("contact's responses (App.handle)",
+             poll.responses.filter(contact=contact_id)),
+            ("page of responses (view_responses)",
+             poll.responses.order_by('-date', '-pk')[:50]),
+            ("a response's category (processing)",
+             ResponseCategory.objects.filter(response=response.pk if response else 0,
+                                             category=category.pk if category else 0)),
+            ("rule-made categorizations (reprocessing)",
+             ResponseCategory.objects.filter(category=category.pk if category else 0, is_override=False)),
+        ]
+
+    def handle(self, **options):
+        connection = connections[options['database']]
+        prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+        if prefix is None:
+            raise CommandError("Don't know how to explain queries on %s" % connection.vendor)
+        polls = Poll.objects.order_by('-pk')
+        if options['p']:
+            polls = polls.filter(pk=int(options['p']))
+        if not polls.exists():
+            raise CommandError("There is no poll to explain queries for")
+
+        unindexed = 0
+        cursor = connection.cursor()
+        for name, queryset in self.hot_queries(polls[0]):
+            sql, params = queryset.query.get_compiler(options['database']).as_sql()
+            cursor.execute(prefix + sql, params)
+            rows = cursor.fetchall()
+            plan = [' '.join(unicode(column) for column in row) for row in rows]
+            if connection.vendor == 'mysql':
+                # the key column names the index each table is read through
+                uses_index = all(row[5] is not None for row in rows)
+            else:
+                uses_index = any('index' in line.lower() for line in plan)
+            if not uses_index:
+                unindexed += 1
+            self.stdout.write("%s: %s\n" % (name, 'ok' if uses_index else 'NO INDEX'))
+            for line in plan:
+                self.stdout.write("    %s\n" % line)
+        if unindexed:
+            raise CommandError("%d hot queries don't use an index" % unindexed)
@@ -0,0 +1,26 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from poll.models import Poll
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = "Recompute the maintained response, responder and audience counters on polls"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        )
+
+    def handle(self, **options):
+        polls = Poll.objects.order_by('pk')
+        if options['p']:
+            polls = polls.filter(pk=int(options['p']))
+        for poll in polls:
+            before = (poll.response_count, poll.responder_count, poll.audience_count)
+            poll.reconcile_counters()
+            after = (poll.response_count, poll.responder_count, poll.audience_count)
+            if before != after:
+                self.stdout.write("poll %d: %s -> %s\n" % (poll.pk, before, after))
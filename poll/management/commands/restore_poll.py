@@ -0,0 +1,25 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from poll.models import Poll
+from poll.archive import restore_poll
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = "Bring an archived poll's responses back into the hot tables"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--poll', dest='p'),
+        )
+
+    def handle(self, **options):
+        if not options['p']:
+            raise CommandError("Which poll? Pass it with -p")
+        poll = Poll.objects.get(pk=int(options['p']))
+        if not poll.is_archived():
+            raise CommandError("poll %d isn't archived" % poll.pk)
+        restore_poll(poll)
+        self.stdout.write("poll %d: %d responses restored\n" % (poll.pk, poll.responses.count()))
@@ -0,0 +1,132 @@
+import gzip
+from collections import namedtuple
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from django.utils import simplejson
+
+from rapidsms.contrib.locations.models import Location
+
+from location_index import get_location_index, location_placer
+from models import ResponseRollup
+from replica import current_report_database
+from report_cache import REPORT_CACHE_TIMEOUT, get_data_version, reads_are_current
+
+# extracted points are also keyed on the location tree version, so this only
+# bounds how long an unused level lingers
+MAP_POINTS_TIMEOUT = getattr(settings, 'POLL_MAP_POINTS_TIMEOUT', 60 * 60 * 24)
+
+# coordinates are published to 5 decimal places (about a metre)
+COORDINATE_PRECISION = 5
+
+MapPoint = namedtuple('MapPoint', 'pk name tree_id lft rght coordinates')
+
+
+def get_level_points(level):
+    """
+    Returns the locations at a tree level that have a point, with their
+    GeoJSON coordinates ([lon, lat]) already extracted and rounded, so that
+    building a layer does no per-row geometry work.
+    """
+    version = get_location_index().version
+    key = 'poll:map_points:%s:%d' % (version, level)
+    points = cache.get(key) if version is not None else None
+    if points is None:
+        rows = Location.objects.filter(level=level, point__isnull=False) \
+            .order_by('tree_id', 'lft') \
+            .values_list('pk', 'name', 'tree_id', 'lft', 'rght', 'point__longitude', 'point__latitude')
+        points = [MapPoint(pk, name, tree_id, lft, rght,
+                           [round(float(lon), COORDINATE_PRECISION), round(float(lat), COORDINATE_PRECISION)])
+                  for pk, name, tree_id, lft, rght, lon, lat in rows]
+        if version is not None:
+            cache.set(key, points, MAP_POINTS_TIMEOUT)
+    return points
+
+
+def build_category_layer(poll, level):
+    """
+    Builds a GeoJSON FeatureCollection with one point feature per location
+    at `level`, carrying the poll's response counts per category.  Counts
+    come from the hourly rollups rather than the raw responses.
+    Uncategorized counts are the rollup total less the categorized counts,
+    so they are a lower bound where responses carry several categories.
+    """
+    points = get_level_points(level)
+    place = location_placer(points)
+    categories = list(poll.categories.filter(deleted=False).order_by('name').values_list('pk', 'name', 'color'))
+
+    totals = [0] * len(points)
+    counts = [{} for point in points]
+    rollups = ResponseRollup.objects.filter(poll=poll, location__isnull=False) \
+        .values_list('location__tree_id', 'location__lft', 'category') \
+        .annotate(Sum('count')).order_by()
+    for tree_id, lft, category_id, count in rollups:
+        index = place(tree_id, lft)
+        if index is None:
+            continue
+        if category_id is None:
+            totals[index] += count
+        else:
+            counts[index][category_id] = counts[index].get(category_id, 0) + count
+
+    features = []
+    for point, total, category_counts in zip(points, totals, counts):
+        if not total:
+            continue
+        data = [{'name': name, 'color': color, 'value': category_counts.get(pk, 0)}
+                for pk, name, color in categories]
+        uncategorized = total - sum(category_counts.values())
+        if uncategorized > 0:
+            data.append({'name': 'uncategorized', 'color': '', 'value': uncategorized})
+        features.append({
+            'type': 'Feature',
+            'id': point.pk,
+            'geometry': {'type': 'Point', 'coordinates': point.coordinates},
+            'properties': {
+                'location_id': point.pk,
+                'location_name': point.name,
+                'total': total,
+                'categories': data,
+            },
+        })
+
+    return {
+        'type': 'FeatureCollection',
+        'properties': {'layer_title': 'Survey:%s' % poll.name, 'layer_type': 'categorized', 'level': level},
+        'features': features,
+    }
+
+
+def compress(content):
+    buf = StringIO()
+    out = gzip.GzipFile(fileobj=buf, mode='wb')
+    try:
+        out.write(content)
+    finally:
+        out.close()
+    return buf.getvalue()
+
+
+def decompress(payload):
+    return gzip.GzipFile(fileobj=StringIO(payload)).read()
+
+
+def get_map_layer(poll, level):
+    """
+    Returns (data version, gzipped GeoJSON) for a poll's layer at a location
+    level.  The layer is serialized and compressed once per data version.
+    The version is None for a layer that isn't cached: one read from a
+    replica that may not have caught up with it, or built while the cache
+    keeps no version.
+    """
+    version = get_data_version(poll.pk)
+    key = 'poll:map_layer:%s:%s:%s' % (poll.pk, level, version)
+    payload = cache.get(key) if version is not None else None
+    if payload is None:
+        payload = compress(simplejson.dumps(build_category_layer(poll, level)))
+        if version is None or not reads_are_current(poll.pk, current_report_database()):
+            return None, payload
+        cache.set(key, payload, REPORT_CACHE_TIMEOUT)
+    return version, payload
@@ -1,13 +1,14 @@
 import datetime
 import difflib
+import os
 from celery.task import task
 import django
-from django.db import models, transaction
-from django.db.models import Sum, Avg, Count, Max, Min, StdDev
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models import Sum, Avg, Count, Max, Min, StdDev, F
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.contrib.sites.models import Site
 from django.contrib.sites.managers import CurrentSiteManager
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django import forms
 from django.utils.translation import ugettext as _
@@ -24,7 +25,13 @@ from rapidsms.contrib.locations.nested import models as nested_models
 from rapidsms_httprouter.models import Message, MessageBatch
 
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
 import re
+from report_cache import bump_data_version, get_data_version
+from approximate import sketch_position, estimate_cardinality, PRECISION, LOCATION_PRECISION
+from location_index import get_location_index, location_placer
+from eav_ids import get_attribute_ids, get_attribute_slugs, get_content_type_id
 from django.utils.translation import (ugettext, activate, deactivate)
 from dateutil.relativedelta import relativedelta
 
@@ -50,6 +57,38 @@ YES_WORDS = [_('yes'), _('yeah'), _('yep'), _('yay'), 'y']
 
 NO_WORDS = [_('no'), _('nope'), _('nah'), _('nay'),  'n']
 
+# the eav attributes a response's value can be stored in
+VALUE_ATTRIBUTES = ['poll_text_value', 'poll_number_value', 'poll_location_value']
+
+# where response values live: in django-eav, in the native columns on
+# Response, or both while moving from one to the other ('dual' writes both
+# and reads the native column, falling back to eav until it's backfilled).
+# Going back from 'native', switch to 'dual' and run backfill_eav_values
+# before 'eav', or the values written in 'native' are lost to the reports
+VALUE_STORAGE_EAV = 'eav'
+VALUE_STORAGE_DUAL = 'dual'
+VALUE_STORAGE_NATIVE = 'native'
+VALUE_STORAGE = getattr(settings, 'POLL_VALUE_STORAGE', VALUE_STORAGE_EAV)
+
+# the aggregates reported for numeric polls, named as the eav queries name them
+NUMERIC_AGGREGATES = (
+    ('value_float__sum', Sum),
+    ('value_float__count', Count),
+    ('value_float__avg', Avg),
+    ('value_float__stddev', StdDev),
+    ('value_float__max', Max),
+    ('value_float__min', Min),
+)
+
+# whether ending a poll queues the first build of its results snapshot with
+# celery; otherwise the build_poll_snapshots command builds them, e.g. from
+# cron.  Rebuilds after a change to an ended poll are always queued.
+SNAPSHOT_IN_BACKGROUND = getattr(settings, 'POLL_SNAPSHOT_IN_BACKGROUND', False)
+
+# after how long an export job still pending or running is taken to have
+# been abandoned (its worker died or its task was lost), in seconds
+EXPORT_JOB_TIMEOUT = getattr(settings, 'POLL_EXPORT_JOB_TIMEOUT', 60 * 60 * 6)
+
 
 class ResponseForm(forms.Form):
     def __init__(self, data=None, **kwargs):
@@ -84,6 +123,19 @@ class ResponseCategory(models.Model):
     is_override = models.BooleanField(default=False)
     user = models.ForeignKey(User, null=True)
 
+    # reprocessing also filters on (category, is_override), indexed in migration 0016
+    class Meta:
+        unique_together = (('response', 'category'),)
+
+
+class LiveManager(models.Manager):
+    """
+    Leaves out rows that have been deleted but not yet purged.
+    """
+
+    def get_query_set(self):
+        return super(LiveManager, self).get_query_set().filter(deleted=False)
+
 
 class Poll(models.Model):
     """
@@ -117,6 +169,10 @@ class Poll(models.Model):
 
     )
 
+    # report engines: SQL over the EAV tables, or NumPy arrays held in memory
+    ENGINE_DB = 'db'
+    ENGINE_COLUMNAR = 'columnar'
+
     TYPE_CHOICES = {
         TYPE_NUMERIC: dict(
             label=_('Numeric Response'),
@@ -126,7 +182,8 @@ class Poll(models.Model):
             view_template='polls/response_numeric_view.html',
             edit_template='polls/response_numeric_edit.html',
             report_columns=((('Text', 'text', True, 'message__text', SimpleSorter()),
-                             ('Value', 'value', True, 'eav_values__value_float', SimpleSorter()),
+                             ('Value', 'value', True, 'number_value' if VALUE_STORAGE == VALUE_STORAGE_NATIVE
+                                                      else 'eav_values__value_float', SimpleSorter()),
                              ('Categories', 'categories', True, 'categories__category__name', SimpleSorter()))),
             edit_form=NumericResponseForm),
         TYPE_TEXT: dict(
@@ -157,16 +214,31 @@ class Poll(models.Model):
     messages = models.ManyToManyField(Message, null=True)
     contacts = models.ManyToManyField(Contact, related_name='polls')
     user = models.ForeignKey(User)
+    # every incoming message looks for the contact's open poll by these,
+    # indexed together as (end_date, start_date) in migration 0016
     start_date = models.DateTimeField(null=True)
     end_date = models.DateTimeField(null=True)
     type = models.SlugField(max_length=8, null=True, blank=True)
     default_response = models.CharField(_("default_response"), max_length=160, null=True, blank=True)
     sites = models.ManyToManyField(Site)
-    objects = models.Manager()
+    # set by soft_delete(); the poll is hidden until purge_poll removes it
+    deleted = models.BooleanField(default=False)
+    objects = LiveManager()
+    all_objects = models.Manager()
     on_site = CurrentSiteManager('sites')
     response_type = models.CharField(max_length=1, choices=RESPONSE_TYPE_CHOICES, default=RESPONSE_TYPE_ALL, null=True,
                                      blank=True)
 
+    # whether responder sketches are kept for the approximate reports, at
+    # two upserts per response and two per categorization (one each without
+    # a location); run backfill_poll_rollups after turning it on
+    approximate_reports = models.BooleanField(default=False)
+
+    # maintained by signal handlers below, see reconcile_counters()
+    response_count = models.PositiveIntegerField(default=0)
+    responder_count = models.PositiveIntegerField(default=0)
+    audience_count = models.PositiveIntegerField(default=0)
+
     class Meta:
         permissions = (
             ("can_poll", "Can send polls"),
@@ -254,6 +326,88 @@ class Poll(models.Model):
         log.info("[Poll.create_with_bulk] TRANSACTION COMMIT")
         return poll
 
+    @classmethod
+    def comparison_report(cls, poll_ids, level):
+        """
+        Compares several polls side by side across the locations at a given
+        tree level.  Numeric polls get sum/count/avg/min/max of their values,
+        text polls get counts per category name.  Each kind is computed with
+        one grouped query over (poll, response location) for all the polls
+        at once, and rolled up to the level in memory.  Returns an aligned
+        matrix: rows[i][j] is the cell for locations[i] and polls[j].
+        """
+        found = cls.objects.in_bulk(poll_ids)
+        polls = [found[pk] for pk in poll_ids if pk in found]
+        index = get_location_index()
+        locations = index.at_level(level)
+        place = index.level_placer(level)
+        columns = dict((poll.pk, column) for column, poll in enumerate(polls))
+
+        numeric = [p.pk for p in polls if Poll.TYPE_CHOICES.get(p.type, {}).get('db_type') == Attribute.TYPE_FLOAT]
+        categorical = [p.pk for p in polls if p.pk not in numeric]
+
+        rows = [[None] * len(polls) for location in locations]
+        if numeric and VALUE_STORAGE == VALUE_STORAGE_NATIVE:
+            values = Response.objects.filter(poll__in=numeric).exclude(number_value=None) \
+                .values_list('poll', 'location__tree_id', 'location__lft') \
+                .annotate(Sum('number_value'), Count('number_value'), Max('number_value'), Min('number_value')) \
+                .order_by()
+        elif numeric:
+            values = Value.objects.filter(attribute__in=get_attribute_ids('poll_number_value'),
+                                          entity_ct=get_content_type_id(Response)) \
+                .extra(tables=['poll_response', 'locations_location'],
+                       where=['poll_response.id = eav_value.entity_id',
+                              'poll_response.poll_id IN (%s)' % ','.join(['%s'] * len(numeric)),
+                              'locations_location.id = poll_response.location_id'],
+                       params=numeric,
+                       select={'poll_id': 'poll_response.poll_id',
+                               'tree_id': 'locations_location.tree_id',
+                               'lft': 'locations_location.lft'}) \
+                .values_list('poll_id', 'tree_id', 'lft') \
+                .annotate(Sum('value_float'), Count('value_float'), Max('value_float'), Min('value_float')) \
+                .order_by()
+        if numeric:
+            for poll_id, tree_id, lft, total, count, maximum, minimum in values:
+                position = place(tree_id, lft)
+                if position is None:
+                    continue
+                column = columns[poll_id]
+                cell = rows[position][column]
+                if cell is None:
+                    cell = rows[position][column] = {'sum': 0.0, 'count': 0, 'max': None, 'min': None}
+                cell['sum'] += total or 0.0
+                cell['count'] += count
+                cell['max'] = max(cell['max'], maximum) if cell['max'] is not None else maximum
+                cell['min'] = min(cell['min'], minimum) if cell['min'] is not None else minimum
+            for row in rows:
+                for column in [columns[pk] for pk in numeric]:
+                    cell = row[column] = row[column] or {'sum': 0.0, 'count': 0, 'max': None, 'min': None}
+                    cell['avg'] = cell['sum'] / cell['count'] if cell['count'] else None
+
+        if categorical:
+            counts = ResponseCategory.objects.filter(response__poll__in=categorical, category__deleted=False) \
+                .values_list('response__poll', 'response__location__tree_id', 'response__location__lft',
+                             'category__name') \
+                .annotate(Count('pk')).order_by()
+            for poll_id, tree_id, lft, name, count in counts:
+                position = place(tree_id, lft)
+                if position is None:
+                    continue
+                cell = rows[position][columns[poll_id]]
+                if cell is None:
+                    cell = rows[position][columns[poll_id]] = {}
+                cell[name] = cell.get(name, 0) + count
+            for row in rows:
+                for column in [columns[pk] for pk in categorical]:
+                    row[column] = row[column] or {}
+
+        return {
+            'level': level,
+            'polls': [{'id': p.pk, 'name': p.name, 'type': p.type} for p in polls],
+            'locations': [{'id': l.pk, 'name': l.name} for l in locations],
+            'rows': rows,
+        }
+
     def add_yesno_categories(self):
         """
         This creates a generic yes/no poll categories for a particular poll
@@ -371,9 +525,147 @@ class Poll(models.Model):
 
         self.log_poll_message_info(" TRANSACTION COMMIT")
 
+    def save(self, *args, **kwargs):
+        if self.pk:
+            # the counters are maintained with UPDATEs as responses arrive,
+            # don't clobber them with whatever this instance loaded earlier
+            for counters in Poll.objects.filter(pk=self.pk).values('response_count', 'responder_count',
+                                                                   'audience_count'):
+                self.__dict__.update(counters)
+        super(Poll, self).save(*args, **kwargs)
+
+    def reconcile_counters(self):
+        """
+        Recomputes the maintained response, responder and audience counters
+        (and the Responder rows) from scratch, for repairing drift (e.g. after raw sql or bulk updates,
+        which bypass the signal handlers).
+        """
+        responding = set(self.responses.exclude(contact=None).values_list('contact', flat=True).distinct())
+        recorded = set(self.responders.values_list('contact', flat=True))
+        self.responders.exclude(contact__in=responding).delete()
+        for contact_id in responding - recorded:
+            # located where they were when they first answered
+            location_id = self.responses.filter(contact=contact_id).order_by('date', 'pk') \
+                .values_list('location', flat=True)[0]
+            Responder.objects.get_or_create(poll=self, contact_id=contact_id, defaults={'location_id': location_id})
+
+        self.response_count = self.responses.count()
+        self.responder_count = len(responding)
+        self.audience_count = self.contacts.count()
+        Poll.objects.filter(pk=self.pk).update(response_count=self.response_count,
+                                               responder_count=self.responder_count,
+                                               audience_count=self.audience_count)
+
+    def get_response_rate(self):
+        """
+        The percentage of the poll's audience that has responded at least
+        once, read from the maintained counters.
+        """
+        if not self.audience_count:
+            return None
+        return self.responder_count * 100.0 / self.audience_count
+
+    def response_rates_by_location(self, location):
+        """
+        Breaks the response rate down by the children of a location (or by the
+        location itself if it's a leaf).  Responders come from the maintained
+        Responder rows, located where the contact was when they first
+        answered; the audience is grouped by current reporting location.
+        Each side is a single grouped query, placed under its child location
+        by the nested-set bounds.
+        """
+        index = get_location_index()
+        children = index.children(location.pk) or [index.by_pk[location.pk]]
+        place = location_placer(children)
+
+        def tally(rows):
+            totals = [0] * len(children)
+            for tree_id, lft, count in rows:
+                index = place(tree_id, lft)
+                if index is not None:
+                    totals[index] += count
+            return totals
+
+        responders = tally(self.responders.filter(location__tree_id=location.tree_id)
+                           .values_list('location__tree_id', 'location__lft').annotate(Count('pk')).order_by())
+        audience = tally(self.contacts.filter(reporting_location__tree_id=location.tree_id)
+                         .values_list('reporting_location__tree_id', 'reporting_location__lft')
+                         .annotate(Count('pk')).order_by())
+
+        rates = []
+        for child, responded, contacted in zip(children, responders, audience):
+            rates.append({
+                'location_name': child.name,
+                'location_id': child.pk,
+                'responders': responded,
+                'audience': contacted,
+                'response_rate': responded * 100.0 / contacted if contacted else None,
+            })
+        return rates
+
+    def response_timeseries(self, start=None, end=None, category=None, location=None, by_category=False):
+        """
+        Hourly response counts from the maintained rollups, as a list of
+        (hour, count) in time order, or a dict of such lists keyed by category
+        name if by_category is set.  A location includes everything beneath
+        it in the tree.
+        """
+        rollups = ResponseRollup.objects.filter(poll=self)
+        if start:
+            rollups = rollups.filter(hour__gte=start)
+        if end:
+            rollups = rollups.filter(hour__lt=end)
+        if location:
+            rollups = rollups.filter(location__tree_id=location.tree_id,
+                                     location__lft__gte=location.lft,
+                                     location__rght__lte=location.rght)
+        if by_category:
+            rows = rollups.exclude(category=None).values_list('category__name', 'hour') \
+                .annotate(Sum('count')).order_by('category__name', 'hour')
+            series = {}
+            for name, hour, count in rows:
+                series.setdefault(name, []).append((hour, count))
+            return series
+
+        rows = rollups.filter(category=category).values_list('hour').annotate(Sum('count')).order_by('hour')
+        return list(rows)
+
     def end(self):
         self.end_date = datetime.datetime.now()
         self.save()
+        if SNAPSHOT_IN_BACKGROUND:
+            build_result_snapshot.delay(self.pk)
+
+    def soft_delete(self):
+        """
+        Hides the poll at once (Poll.objects leaves it out, so no message
+        is routed to it) and queues the deletion of its rows, which for a
+        big poll is far too much to delete, or even collect, in a request.
+        """
+        Poll.all_objects.filter(pk=self.pk).update(deleted=True)
+        self.deleted = True
+        purge_poll.delay(self.pk)
+
+    def is_archived(self):
+        return PollArchive.objects.filter(poll=self).exists()
+
+    def get_result_snapshot(self):
+        """
+        Returns the frozen results of an ended poll, or None if the poll is
+        still open or its snapshot is missing or out of date, in which case
+        callers fall back to the live reports until build_poll_snapshots
+        (or the task queued by end() or by the change) builds it.
+        """
+        if not self.end_date:
+            return None
+        try:
+            snapshot = ResultSnapshot.objects.get(poll=self)
+        except ResultSnapshot.DoesNotExist:
+            return None
+        # an archived poll's responses are gone, so its snapshot is the last word on it
+        if snapshot.is_current() or self.is_archived():
+            return snapshot.get_results()
+        return None
 
     def reprocess_responses(self):
         for rc in ResponseCategory.objects.filter(category__poll=self, is_override=False):
@@ -384,18 +676,19 @@ class Poll(models.Model):
             for category in self.categories.all():
                 for rule in category.rules.all():
                     regex = re.compile(rule.regex, re.IGNORECASE | re.UNICODE)
-                    if resp.eav.poll_text_value:
-                        if regex.search(resp.eav.poll_text_value.lower()) and not resp.categories.filter(
+                    if resp.poll_text_value:
+                        if regex.search(resp.poll_text_value.lower()) and not resp.categories.filter(
                                 category=category).count():
                             if category.error_category:
                                 resp.has_errors = True
-                            rc = ResponseCategory.objects.create(response=resp, category=category)
+                            # the response may be categorized meanwhile (by a
+                            # concurrent reprocess), and may only be once
+                            ResponseCategory.objects.get_or_create(response=resp, category=category)
                             break
             if not resp.categories.all().count() and self.categories.filter(default=True).count():
                 if self.categories.get(default=True).error_category:
                     resp.has_errors = True
-                resp.categories.add(
-                    ResponseCategory.objects.create(response=resp, category=self.categories.get(default=True)))
+                ResponseCategory.objects.get_or_create(response=resp, category=self.categories.get(default=True))
             resp.save()
 
     def process_response(self, message):
@@ -404,18 +697,19 @@ class Poll(models.Model):
             db_message = message.db_message
         else:
             db_message = message
-        resp = Response.objects.create(poll=self, message=db_message, contact=db_message.connection.contact,
-                                       date=db_message.date)
-
-        self.log_poll_message_debug("Response PK ={}".format(str(resp.pk)))
+        contact = db_message.connection.contact
+        # the response is worked out in full before anything is written, so
+        # that it's inserted once with its final values, then its categories
+        resp = Response(poll=self, message=db_message, contact=contact, date=db_message.date,
+                        location_id=getattr(contact, 'reporting_location_id', None))
+        categories = []
         outgoing_message = self.default_response
 
         if self.type == Poll.TYPE_LOCATION:
             typedef = Poll.TYPE_CHOICES[self.type]
             try:
                 cleaned_value = typedef['parser'](message.text)
-                resp.eav.poll_location_value = cleaned_value
-                resp.save()
+                resp.poll_location_value = cleaned_value
             except ValidationError as e:
                 resp.has_errors = True
 
@@ -426,7 +720,7 @@ class Poll(models.Model):
                 #'19'or '19 years' or '19years' or 'age19'or 'ugx34.56shs' it returns a list of length 4
                 msg_parts = regex.split(message.text)
                 if len(msg_parts) == 4:
-                    resp.eav.poll_number_value = float(msg_parts[1])
+                    resp.poll_number_value = float(msg_parts[1])
 
                 else:
                     resp.has_errors = True
@@ -434,30 +728,30 @@ class Poll(models.Model):
                 resp.has_errors = True
 
         elif (self.type == Poll.TYPE_TEXT) or (self.type == Poll.TYPE_REGISTRATION):
-            resp.eav.poll_text_value = message.text
+            resp.poll_text_value = message.text
             if self.categories:
                 for category in self.categories.all():
                     for rule in category.rules.all():
                         regex = re.compile(rule.regex, re.IGNORECASE | re.UNICODE)
                         if regex.search(message.text.lower()):
-                            rc = ResponseCategory.objects.create(response=resp, category=category)
-                            resp.categories.add(rc)
+                            categories.append(category)
                             if category.error_category:
                                 resp.has_errors = True
                             if category.response:
                                 outgoing_message = category.response
+                            break
 
         elif self.type in Poll.TYPE_CHOICES:
             typedef = Poll.TYPE_CHOICES[self.type]
             try:
                 cleaned_value = typedef['parser'](message.text)
                 if typedef['db_type'] == Attribute.TYPE_TEXT:
-                    resp.eav.poll_text_value = cleaned_value
+                    resp.poll_text_value = cleaned_value
                 elif typedef['db_type'] == Attribute.TYPE_FLOAT or \
                                 typedef['db_type'] == Attribute.TYPE_INT:
-                    resp.eav.poll_number_value = cleaned_value
+                    resp.poll_number_value = cleaned_value
                 elif typedef['db_type'] == Attribute.TYPE_OBJECT:
-                    resp.eav.poll_location_value = cleaned_value
+                    resp.poll_location_value = cleaned_value
             except ValidationError as e:
                 resp.has_errors = True
                 if getattr(e, 'messages', None):
@@ -469,21 +763,37 @@ class Poll(models.Model):
                     outgoing_message = None
 
         self.log_poll_message_debug("checking for categorisation...")
-        if not resp.categories.exists() and self.categories.filter(default=True).exists():
-            resp.categories.add(
-                ResponseCategory.objects.create(response=resp, category=self.categories.get(default=True)))
-            if self.categories.get(default=True).error_category:
-                resp.has_errors = True
-                outgoing_message = self.categories.get(default=True).response
+        if not categories:
+            for default in self.categories.filter(default=True)[:1]:
+                categories.append(default)
+                if default.error_category:
+                    resp.has_errors = True
+                    outgoing_message = default.response
 
         if not resp.has_errors or not outgoing_message:
-            for respcategory in resp.categories.order_by('category__priority'):
-                if respcategory.category.response:
-                    outgoing_message = respcategory.category.response
+            for category in sorted(categories, key=lambda c: c.priority):
+                if category.response:
+                    outgoing_message = category.response
                     break
 
-        self.log_poll_message_debug("Added categories [{}]".format([r.category for r in resp.categories.all()]))
-        resp.save()
+        sid = transaction.savepoint()
+        try:
+            resp.save()
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # the message was already processed (a replay), so there's nothing to do or say;
+            # anything else, e.g. from a post_save handler, is a real error
+            transaction.savepoint_rollback(sid)
+            existing = list(Response.objects.filter(message=db_message)[:1])
+            if not existing:
+                raise
+            self.log_poll_message_debug("message already has a response")
+            return existing[0], None
+        self.log_poll_message_debug("Response PK ={}".format(str(resp.pk)))
+        for category in categories:
+            ResponseCategory.objects.create(response=resp, category=category)
+        self.log_poll_message_debug("Added categories [{}]".format(categories))
+
         if not outgoing_message:
             return resp, None,
         else:
@@ -501,140 +811,233 @@ class Poll(models.Model):
     def get_outgoing_message_batch_name(self):
         return "P%d-O" % self.pk
 
+    def get_response_columns(self):
+        """
+        The poll's responses loaded into NumPy arrays (see columnar.py), for
+        the report functions' engine=Poll.ENGINE_COLUMNAR option.
+        """
+        from columnar import load_columns
+        return load_columns(self)
+
     def get_numeric_detailed_data(self):
-        return Value.objects.filter(attribute__slug='poll_number_value',
-                                    entity_ct=ContentType.objects.get_for_model(Response),
+        if VALUE_STORAGE == VALUE_STORAGE_NATIVE:
+            return self.responses.exclude(number_value=None).values_list('number_value') \
+                .annotate(Count('number_value')).order_by('-number_value')
+        return Value.objects.filter(attribute__in=get_attribute_ids('poll_number_value'),
+                                    entity_ct=get_content_type_id(Response),
                                     entity_id__in=self.responses.all()).values_list('value_float').annotate(
             Count('value_float')).order_by('-value_float')
 
-    def get_numeric_report_data(self, location=None, for_map=None):
-        if location:
-            q = Value.objects.filter(attribute__slug='poll_number_value',
-                                     entity_ct=ContentType.objects.get_for_model(Response),
-                                     entity_id__in=self.responses.all())
-            q = q.extra(tables=['poll_response', 'rapidsms_contact', 'locations_location', 'locations_location'],
-                        where=['poll_response.id = eav_value.entity_id',
-                               'rapidsms_contact.id = poll_response.contact_id',
-                               'locations_location.id = rapidsms_contact.reporting_location_id',
-                               'T7.id in %s' % (str(tuple(location.get_children().values_list('pk', flat=True)))),
-                               'T7.lft <= locations_location.lft', \
-                               'T7.rght >= locations_location.rght', \
-                            ],
-                        select={
-                            'location_name': 'T7.name',
-                            'location_id': 'T7.id',
-                            'lft': 'T7.lft',
-                            'rght': 'T7.rght',
-                        }).values('location_name', 'location_id')
-
+    def get_numeric_report_data(self, location=None, for_map=None, engine=None):
+        if engine == Poll.ENGINE_COLUMNAR:
+            return self.get_response_columns().get_numeric_report_data(location, for_map)
+        if VALUE_STORAGE == VALUE_STORAGE_NATIVE:
+            column, group = 'number_value', 'poll'
+            values = self.responses.exclude(number_value=None)
+            if location:
+                values = values.filter(location__tree_id=location.tree_id,
+                                       location__lft__gte=location.lft, location__lft__lte=location.rght)
         else:
-            q = Value.objects.filter(attribute__slug='poll_number_value',
-                                     entity_ct=ContentType.objects.get_for_model(Response),
-                                     entity_id__in=self.responses.all()).values('entity_ct')
-        q = q.annotate(Sum('value_float'), Count('value_float'), Avg('value_float'), StdDev('value_float'),
-                       Max('value_float'), Min('value_float'))
-        return q
-
-    def responses_by_category(self, location=None, for_map=True):
-        categorized = ResponseCategory.objects.filter(response__poll=self)
-        uncategorized = self.responses.exclude(
-            pk__in=ResponseCategory.objects.filter(response__poll=self).values_list('response', flat=True))
-        uvalues = ['poll__pk']
-
-        if location:
-            if location.get_children().count() == 1:
-                location_where = 'T9.id = %d' % location.get_children()[0].pk
-                ulocation_where = 'T7.id = %d' % location.get_children()[0].pk
-            elif location.get_children().count() == 0:
-                location_where = 'T9.id = %d' % location.pk
-                ulocation_where = 'T7.id = %d' % location.pk
+            column, group = 'value_float', 'entity_ct'
+            values = Value.objects.filter(attribute__in=get_attribute_ids('poll_number_value'),
+                                          entity_ct=get_content_type_id(Response))
+            if location:
+                values = values.extra(tables=['poll_response', 'locations_location'],
+                                      where=['poll_response.id = eav_value.entity_id',
+                                             'poll_response.poll_id = %s',
+                                             'locations_location.id = poll_response.location_id',
+                                             'locations_location.tree_id = %s',
+                                             'locations_location.lft BETWEEN %s AND %s'],
+                                      params=[self.pk, location.tree_id, location.lft, location.rght])
             else:
-                location_where = 'T9.id in %s' % (str(tuple(location.get_children().values_list('pk', flat=True))))
-                ulocation_where = 'T7.id in %s' % (str(tuple(location.get_children().values_list('pk', flat=True))))
-
-            where_list = [
-                'T9.lft <= locations_location.lft',
-                'T9.rght >= locations_location.rght',
-                location_where,
-                'T9.point_id = locations_point.id', ]
-            select = {
-                'location_name': 'T9.name',
-                'location_id': 'T9.id',
-                'lat': 'locations_point.latitude',
-                'lon': 'locations_point.longitude',
-                'rght': 'T9.rght',
-                'lft': 'T9.lft',
-            }
-            tables = ['locations_location', 'locations_point']
-            if not for_map:
-                where_list = where_list[:3]
-                select.pop('lat')
-                select.pop('lon')
-                tables = tables[:1]
-            categorized = categorized \
-                .values('response__message__connection__contact__reporting_location__name') \
-                .extra(tables=tables,
-                       where=where_list) \
-                .extra(select=select)
-
-            uwhere_list = [
-                'T7.lft <= locations_location.lft',
-                'T7.rght >= locations_location.rght',
-                ulocation_where,
-                'T7.point_id = locations_point.id', ]
-            uselect = {
-                'location_name': 'T7.name',
-                'location_id': 'T7.id',
-                'lat': 'locations_point.latitude',
-                'lon': 'locations_point.longitude',
-                'rght': 'T7.rght',
-                'lft': 'T7.lft',
-            }
-            uvalues = ['location_name', 'location_id', 'lat', 'lon']
-            utables = ['locations_location', 'locations_point']
-            if not for_map:
-                uwhere_list = uwhere_list[:3]
-                uselect.pop('lat')
-                uselect.pop('lon')
-                uvalues = uvalues[:2]
-                utables = utables[:1]
-
-            uncategorized = uncategorized \
-                .values('message__connection__contact__reporting_location__name') \
-                .extra(tables=utables,
-                       where=uwhere_list) \
-                .extra(select=uselect)
-
-            values_list = ['location_name', 'location_id', 'category__name', 'category__color', 'lat', 'lon', ]
-            if not for_map:
-                values_list = values_list[:4]
-        else:
-            values_list = ['category__name', 'category__color']
+                values = values.filter(entity_id__in=self.responses.all())
 
-        categorized = categorized.values(*values_list) \
-            .annotate(value=Count('pk')) \
-            .order_by('category__name')
+        names = {}
+        if location:
+            targets = self._report_locations(location)
+            names = dict((t.pk, t.name) for t in targets)
+            case, case_params = self._report_location_case(targets)
+            values = values.extra(select={'report_location': case}, select_params=case_params)
+            group = 'report_location'
+
+        # annotated under plain aliases, and renamed to the reported keys below
+        aggregates = dict((name.replace('__', '_'), aggregate(column)) for name, aggregate in NUMERIC_AGGREGATES)
+        report = []
+        for row in values.values(group).annotate(**aggregates).order_by():
+            report_row = dict((name, row[name.replace('__', '_')]) for name, aggregate in NUMERIC_AGGREGATES)
+            if location:
+                if row['report_location'] is None:
+                    continue
+                report_row.update({'location_name': names[row['report_location']],
+                                   'location_id': row['report_location']})
+            report.append(report_row)
+        return sorted(report, key=lambda r: r.get('location_name'))
+
+    def _report_locations(self, location):
+        """
+        The locations a report on `location` is broken down by, as location
+        index nodes: its children, or the location itself if it's a leaf.
+        """
+        index = get_location_index()
+        return index.children(location.pk) or [index.by_pk[location.pk]]
 
-        uncategorized = uncategorized.values(*uvalues).annotate(value=Count('pk'))
+    def _report_location_ids(self, location):
+        return [node.pk for node in self._report_locations(location)]
 
-        if location:
-            categorized = categorized.extra(order_by=['location_name'])
-            uncategorized = uncategorized.extra(order_by=['location_name'])
-            if for_map:
+    @staticmethod
+    def _report_location_case(targets):
+        """
+        Returns (sql, params) for a CASE expression that maps a joined
+        locations_location row to the pk of the target location containing
+        it, or NULL, so reports can group by target in a single query.
+        """
+        whens = []
+        params = []
+        for target in targets:
+            whens.append('WHEN locations_location.tree_id = %s AND locations_location.lft BETWEEN %s AND %s THEN %s')
+            params.extend([target.tree_id, target.lft, target.rght, target.pk])
+        return 'CASE %s END' % ' '.join(whens), params
+
+    def responses_by_category(self, location=None, for_map=True, engine=None):
+        if engine == Poll.ENGINE_COLUMNAR:
+            return self.get_response_columns().responses_by_category(location, for_map)
+        categorized = ResponseCategory.objects.filter(response__poll=self, category__deleted=False)
+        uncategorized = self.responses.exclude(
+            pk__in=categorized.values_list('response', flat=True))
+
+        if not location:
+            categorized = categorized.values('category__name', 'category__color') \
+                .annotate(value=Count('pk')).order_by('category__name')
+            uncategorized = uncategorized.values('poll__pk').annotate(value=Count('pk'))
+            if len(uncategorized):
+                uncategorized = list(uncategorized)
                 for d in uncategorized:
-                    d['lat'] = '%.5f' % float(d['lat'])
-                    d['lon'] = '%.5f' % float(d['lon'])
-                for d in categorized:
-                    d['lat'] = '%.5f' % float(d['lat'])
-                    d['lon'] = '%.5f' % float(d['lon'])
-
-        if len(uncategorized):
-            uncategorized = list(uncategorized)
-            for d in uncategorized:
-                d.update({'category__name': 'uncategorized', 'category__color': ''})
-            categorized = list(categorized) + uncategorized
+                    d.update({'category__name': 'uncategorized', 'category__color': ''})
+                categorized = list(categorized) + uncategorized
+            return categorized
+
+        # responses are placed where the contact was when they answered
+        targets = self._report_locations(location)
+        case, case_params = self._report_location_case(targets)
+
+        def by_location(responses, prefix, fields):
+            return responses.filter(**{prefix + 'location__tree_id': location.tree_id,
+                                       prefix + 'location__lft__gte': location.lft,
+                                       prefix + 'location__lft__lte': location.rght}) \
+                .extra(select={'report_location': case}, select_params=case_params) \
+                .values('report_location', *fields).annotate(value=Count('pk')).order_by()
+
+        rows = list(by_location(categorized, 'response__', ['category__name', 'category__color']))
+        for d in by_location(uncategorized, '', []):
+            d.update({'category__name': 'uncategorized', 'category__color': ''})
+            rows.append(d)
+
+        names = dict((t.pk, t.name) for t in targets)
+        points = self._report_points(names.keys()) if for_map else {}
+
+        report = []
+        for row in rows:
+            location_id = row.pop('report_location')
+            if location_id is None or (for_map and location_id not in points):
+                continue
+            row.update({'location_name': names[location_id], 'location_id': location_id})
+            if for_map:
+                row['lat'], row['lon'] = points[location_id]
+            report.append(row)
+        # grouped by location, categories by name and uncategorized last, as view_report reads them
+        report.sort(key=lambda r: (r['location_name'], r['location_id'],
+                                   r['category__name'] == 'uncategorized', r['category__name']))
+        return report
+
+    @staticmethod
+    def _report_points(location_ids):
+        """
+        Returns {location pk: (lat, lon)} for the locations that have a
+        point, formatted as the map layers expect them.
+        """
+        points = {}
+        for pk, lat, lon in Location.objects.filter(pk__in=location_ids).exclude(point=None) \
+                .values_list('pk', 'point__latitude', 'point__longitude'):
+            points[pk] = ('%.5f' % float(lat), '%.5f' % float(lon))
+        return points
 
-        return categorized
+    def approximate_responses_by_category(self, location=None, for_map=False):
+        """
+        A fast stand-in for responses_by_category(location, for_map) on very
+        large live polls, with no scan of raw responses.  Response counts
+        come from the hourly rollups.  For a poll with approximate_reports
+        set, each row also estimates the distinct responders in it from the
+        HyperLogLog sketches, with the estimate's standard error (about 0.8%
+        of it for the whole poll, 3.3% by location).  Uncategorized counts
+        are the rollup total less the categorized counts.
+        """
+        categories = list(self.categories.order_by('name').values_list('pk', 'name', 'color'))
+        rollups = self.rollups.all()
+        sketches = self.responder_sketches.all()
+        if location is None:
+            targets = [None]
+            place = lambda tree_id, lft: 0
+        else:
+            targets = sorted(self._report_locations(location), key=lambda l: l.name)
+            place = location_placer(targets)
+            rollups = rollups.filter(location__tree_id=location.tree_id)
+            sketches = sketches.filter(location__tree_id=location.tree_id)
+
+        counts = {}
+        for tree_id, lft, category_id, count in rollups \
+                .values_list('location__tree_id', 'location__lft', 'category').annotate(Sum('count')).order_by():
+            index = place(tree_id, lft)
+            if index is not None:
+                counts[(index, category_id)] = counts.get((index, category_id), 0) + count
+
+        registers = {}
+        rows = []
+        precision = PRECISION if location is None else LOCATION_PRECISION
+        # NULL locations don't clash in the unique constraint, but a register
+        # created twice only repeats a rank, which the MAX absorbs
+        if self.approximate_reports and location is None:
+            rows = sketches.filter(location=None).values_list('category', 'register') \
+                .annotate(Max('rank')).order_by()
+            rows = ((None, None, category_id, bucket, rank) for category_id, bucket, rank in rows)
+        elif self.approximate_reports:
+            rows = sketches.values_list('location__tree_id', 'location__lft', 'category', 'register') \
+                .annotate(Max('rank')).order_by()
+        for tree_id, lft, category_id, bucket, rank in rows:
+            index = place(tree_id, lft)
+            if index is not None:
+                sketch = registers.setdefault((index, category_id), {})
+                sketch[bucket] = max(sketch.get(bucket, 0), rank)
+
+        points = {}
+        if for_map and location is not None:
+            points = self._report_points([target.pk for target in targets])
+        report = []
+        for index, target in enumerate(targets):
+            labels = {}
+            if target is not None:
+                if for_map and target.pk not in points:
+                    continue
+                labels = {'location_name': target.name, 'location_id': target.pk}
+                if for_map:
+                    labels['lat'], labels['lon'] = points[target.pk]
+            categorized = 0
+            for pk, name, color in categories:
+                count = counts.get((index, pk), 0)
+                if not count:
+                    continue
+                categorized += count
+                responders = error = None
+                if self.approximate_reports:
+                    responders, error = estimate_cardinality(registers.get((index, pk), {}), precision)
+                    responders, error = int(round(responders)), round(error, 1)
+                row = dict(labels, category__name=name, category__color=color, value=count,
+                           responders=responders, responders_error=error)
+                report.append(row)
+            uncategorized = counts.get((index, None), 0) - categorized
+            if uncategorized > 0:
+                report.append(dict(labels, category__name='uncategorized', category__color='', value=uncategorized,
+                                   responders=None, responders_error=None))
+        return report
 
     def process_uncategorized(self):
         responses = self.responses.filter(categories__category=None)
@@ -643,38 +1046,85 @@ class Poll(models.Model):
             for category in self.categories.all():
                 for rule in category.rules.all():
                     regex = re.compile(rule.regex, re.IGNORECASE | re.UNICODE)
-                    if resp.eav.poll_text_value:
-                        if regex.search(resp.eav.poll_text_value.lower()) and not resp.categories.filter(
+                    if resp.poll_text_value:
+                        if regex.search(resp.poll_text_value.lower()) and not resp.categories.filter(
                                 category=category).count():
                             if category.error_category:
                                 resp.has_errors = True
-                            rc = ResponseCategory.objects.create(response=resp, category=category)
+                            # the response may be categorized meanwhile (by a
+                            # concurrent reprocess), and may only be once
+                            ResponseCategory.objects.get_or_create(response=resp, category=category)
                             break
             if not resp.categories.all().count() and self.categories.filter(default=True).count():
                 if self.categories.get(default=True).error_category:
                     resp.has_errors = True
-                resp.categories.add(
-                    ResponseCategory.objects.create(response=resp, category=self.categories.get(default=True)))
+                ResponseCategory.objects.get_or_create(response=resp, category=self.categories.get(default=True))
             resp.save()
 
-    def responses_by_age(self, lower_bound_in_years, upper_bound_in_years):
+    def responses_by_age(self, lower_bound_in_years, upper_bound_in_years, engine=None):
+        if engine == Poll.ENGINE_COLUMNAR:
+            return self.get_response_columns().responses_by_age(lower_bound_in_years, upper_bound_in_years)
         lower_bound_date = datetime.datetime.now() - relativedelta(years=lower_bound_in_years)
         upper_bound_date = datetime.datetime.now() - relativedelta(years=upper_bound_in_years)
-        category_dicts = ResponseCategory.objects.filter(response__poll=self,
+        category_dicts = ResponseCategory.objects.filter(response__poll=self, category__deleted=False,
                                                          response__contact__birthdate__gte=upper_bound_date,
                                                          response__contact__birthdate__lte=lower_bound_date).values(
             'category__name').annotate(
             value=Count('pk'))
         return [self._get_formatted_values_for_bar_chart(category_dict) for category_dict in category_dicts]
 
-    def responses_by_gender(self, gender):
+    def responses_by_gender(self, gender, engine=None):
         assert self.is_yesno_poll()
+        if engine == Poll.ENGINE_COLUMNAR:
+            return self.get_response_columns().responses_by_gender(gender)
         values_list = ['category__name']
-        category_dicts = ResponseCategory.objects.filter(response__poll=self,
+        category_dicts = ResponseCategory.objects.filter(response__poll=self, category__deleted=False,
                                                          response__contact__gender__iexact=gender).values(
             *values_list).annotate(value=Count('pk'))
         return [self._get_formatted_values_for_bar_chart(category_dict) for category_dict in category_dicts]
 
+    def responses_by_demographics(self, age_edges):
+        """
+        Counts categorized responses for every age bucket x gender x category
+        in a single grouped query.  age_edges is an ascending list of ages in
+        years, bucket i covering [age_edges[i], age_edges[i + 1]).  Buckets
+        are assigned in SQL with a CASE over the contact's birthdate, and the
+        result is dense: combinations with no responses are reported as 0.
+        """
+        age_edges = sorted(age_edges)
+        buckets = zip(age_edges[:-1], age_edges[1:])
+        now = datetime.datetime.now()
+        whens = []
+        params = []
+        for index, (lower, upper) in enumerate(buckets):
+            whens.append('WHEN rapidsms_contact.birthdate <= %%s AND rapidsms_contact.birthdate > %%s THEN %d' % index)
+            params.extend([now - relativedelta(years=lower), now - relativedelta(years=upper)])
+
+        counts = {}
+        genders = set()
+        if buckets:
+            rows = ResponseCategory.objects.filter(response__poll=self, category__deleted=False,
+                                                   response__contact__birthdate__isnull=False) \
+                .extra(select={'age_bucket': 'CASE %s END' % ' '.join(whens)}, select_params=params) \
+                .values('age_bucket', 'response__contact__gender', 'category__name') \
+                .annotate(value=Count('pk')).order_by()
+            for row in rows:
+                if row['age_bucket'] is None:
+                    continue
+                gender = (row['response__contact__gender'] or '').upper()
+                genders.add(gender)
+                key = (int(row['age_bucket']), gender, row['category__name'])
+                counts[key] = counts.get(key, 0) + row['value']
+
+        categories = list(self.categories.order_by('name').values_list('name', flat=True))
+        data = []
+        for index, (lower, upper) in enumerate(buckets):
+            for gender in sorted(genders):
+                for category in categories:
+                    data.append({'lower': lower, 'upper': upper, 'gender': gender, 'category': category,
+                                 'value': counts.get((index, gender, category), 0)})
+        return data
+
     def __unicode__(self):
         if self.start_date:
             sd = self.start_date.date()
@@ -702,10 +1152,26 @@ class Category(models.Model):
     default = models.BooleanField(default=False)
     response = models.CharField(max_length=160, null=True)
     error_category = models.BooleanField(default=False)
+    # set by soft_delete(); the category is hidden until purge_category removes it
+    deleted = models.BooleanField(default=False)
+    objects = LiveManager()
+    all_objects = models.Manager()
 
     class Meta:
         ordering = ['name']
 
+    def soft_delete(self):
+        """
+        Hides the category at once and queues the deletion of its
+        categorizations, which can be too many to delete in a request.
+        Its rules go now, so no new response is put in it meanwhile.
+        """
+        self.rules.all().delete()
+        Category.all_objects.filter(pk=self.pk).update(deleted=True, default=False)
+        self.deleted, self.default = True, False
+        poll_data_changed(self.poll)
+        purge_category.delay(self.pk)
+
     @classmethod
     def clear_defaults(cls, poll):
         for c in Category.objects.filter(poll=poll, default=True):
@@ -728,11 +1194,96 @@ class Response(models.Model):
     able to override a particular response as belonging to a particular
     category, which shouldn't be overridden by new rules.
     """
-    message = models.ForeignKey(Message, null=True, related_name='poll_responses')
+    # one response per message, so that a replayed message is recognised
+    message = models.ForeignKey(Message, null=True, unique=True, related_name='poll_responses')
     poll = models.ForeignKey(Poll, related_name='responses')
     contact = models.ForeignKey(Contact, null=True, blank=True, related_name='responses')
+    # where the contact was reporting from when they answered; location
+    # reports group on this (indexed with poll) rather than the contact's
+    # current reporting location
+    location = models.ForeignKey(Location, null=True, blank=True, related_name='poll_responses')
+    # responses are looked up by (poll, contact) for each message and paged
+    # by (poll, date); both are indexed in migration 0016
     date = models.DateTimeField(auto_now_add=True)
     has_errors = models.BooleanField(default=False)
+    # native value columns, used according to POLL_VALUE_STORAGE
+    text_value = models.TextField(null=True, blank=True)
+    number_value = models.FloatField(null=True, blank=True)
+    location_value = models.ForeignKey(Location, null=True, blank=True, related_name='poll_value_responses')
+
+    def _get_value(self, slug, column):
+        if VALUE_STORAGE != VALUE_STORAGE_EAV:
+            value = getattr(self, column)
+            if value is not None or VALUE_STORAGE == VALUE_STORAGE_NATIVE:
+                return value
+        return getattr(self.eav, slug)
+
+    def _set_value(self, slug, column, value):
+        if VALUE_STORAGE != VALUE_STORAGE_NATIVE:
+            setattr(self.eav, slug, value)
+        if VALUE_STORAGE != VALUE_STORAGE_EAV:
+            setattr(self, column, value)
+
+    # read and write these rather than resp.eav.*, so that the value storage can be switched
+    poll_text_value = property(lambda self: self._get_value('poll_text_value', 'text_value'),
+                               lambda self, value: self._set_value('poll_text_value', 'text_value', value))
+    poll_number_value = property(lambda self: self._get_value('poll_number_value', 'number_value'),
+                                 lambda self, value: self._set_value('poll_number_value', 'number_value', value))
+    poll_location_value = property(lambda self: self._get_value('poll_location_value', 'location_value'),
+                                   lambda self, value: self._set_value('poll_location_value', 'location_value',
+                                                                       value))
+
+    def save(self, *args, **kwargs):
+        if not self.pk and self.location_id is None and self.contact_id:
+            self.location_id = getattr(self.contact, 'reporting_location_id', None)
+        super(Response, self).save(*args, **kwargs)
+
+    @classmethod
+    def prefetch_values(cls, responses, using=None):
+        """
+        Loads the eav values of many responses with one query (plus one for
+        any location values) and caches them on each response's eav entity,
+        so that reading resp.poll_*_value doesn't query once per row.  With
+        native value columns, only their locations need loading.  `using`
+        picks the database to read from, as for the responses themselves.
+        """
+        if VALUE_STORAGE != VALUE_STORAGE_EAV:
+            locations = Location.objects.db_manager(using) \
+                .in_bulk(set(r.location_value_id for r in responses if r.location_value_id))
+            for resp in responses:
+                if resp.location_value_id:
+                    resp.location_value = locations.get(resp.location_value_id)
+            if VALUE_STORAGE == VALUE_STORAGE_NATIVE:
+                return responses
+
+        by_pk = dict((r.pk, r) for r in responses)
+        for resp in responses:
+            for slug in VALUE_ATTRIBUTES:
+                setattr(resp.eav, slug, None)
+        if not by_pk:
+            return responses
+
+        location_values = []
+        slugs = get_attribute_slugs(*VALUE_ATTRIBUTES)
+        rows = Value.objects.db_manager(using).filter(entity_ct=get_content_type_id(cls),
+                                                      entity_id__in=by_pk.keys(),
+                                                      attribute__in=slugs.keys()) \
+            .values_list('entity_id', 'attribute', 'value_text', 'value_float', 'generic_value_id')
+        for entity_id, attribute_id, value_text, value_float, generic_value_id in rows:
+            slug = slugs[attribute_id]
+            if slug == 'poll_text_value':
+                setattr(by_pk[entity_id].eav, slug, value_text)
+            elif slug == 'poll_number_value':
+                setattr(by_pk[entity_id].eav, slug, value_float)
+            else:
+                location_values.append((entity_id, generic_value_id))
+
+        if location_values:
+            locations = Location.objects.db_manager(using) \
+                .in_bulk([location_id for entity_id, location_id in location_values])
+            for entity_id, location_id in location_values:
+                by_pk[entity_id].eav.poll_location_value = locations.get(location_id)
+        return responses
 
     def update_categories(self, categories, user):
         for c in categories:
@@ -746,6 +1297,297 @@ class Response(models.Model):
 register(Response)
 
 
+def poll_data_changed(poll):
+    """
+    Invalidates the cached reports of a poll whose responses or categories
+    have changed and, if it has ended, its results snapshot.
+    """
+    bump_data_version(poll.pk)
+    if poll.end_date:
+        ResultSnapshot.mark_changed(poll.pk)
+
+
+def bump_poll_data_version(sender, instance, **kwargs):
+    """
+    Any change to a response, its categorization, or a poll's categories
+    invalidates the cached reports for that poll.  The poll is reached the
+    way process_response has already loaded it, so a live response costs
+    no query here.
+    """
+    if sender is Response or sender is Category:
+        poll = instance.poll
+    else:
+        poll = instance.response.poll
+    poll_data_changed(poll)
+
+def update_response_counters(sender, instance, **kwargs):
+    """
+    Keeps Poll.response_count, Poll.responder_count and the Responder rows
+    in step with the responses table: one UPDATE per event, plus one
+    indexed lookup to see whether this is the contact's first (or last)
+    response to the poll.  A contact's last response going costs a count
+    of the poll's responders.
+    """
+    if 'created' in kwargs:
+        if not kwargs['created']:
+            return
+        delta = 1
+    else:
+        delta = -1
+
+    updates = {'response_count': F('response_count') + delta}
+    if instance.contact_id:
+        if delta > 0:
+            responder, created = Responder.objects.get_or_create(
+                poll_id=instance.poll_id, contact_id=instance.contact_id,
+                defaults={'location_id': instance.location_id})
+            if created:
+                updates['responder_count'] = F('responder_count') + 1
+        elif not Response.objects.filter(poll=instance.poll_id, contact=instance.contact_id).exists():
+            # recounted rather than decremented: a batch delete sends this for
+            # each of the contact's responses after all of them are gone, and
+            # deleting a contact may take their Responder row first
+            Responder.objects.filter(poll=instance.poll_id, contact=instance.contact_id).delete()
+            updates['responder_count'] = Responder.objects.filter(poll=instance.poll_id).count()
+    Poll.objects.filter(pk=instance.poll_id).update(**updates)
+
+
+def update_audience_counter(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # contact.polls.clear() doesn't say which polls lost the contact
+        instance._cleared_poll_pks = list(instance.polls.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        instance.audience_count = instance.contacts.count()
+        Poll.objects.filter(pk=instance.pk).update(audience_count=instance.audience_count)
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_poll_pks', [])
+    for poll in Poll.objects.filter(pk__in=pk_set or []):
+        Poll.objects.filter(pk=poll.pk).update(audience_count=poll.contacts.count())
+
+post_save.connect(update_response_counters, sender=Response)
+post_delete.connect(update_response_counters, sender=Response)
+m2m_changed.connect(update_audience_counter, sender=Poll.contacts.through)
+
+def update_response_rollups(sender, instance, **kwargs):
+    """
+    Keeps the hourly ResponseRollup rows in step: responses count towards
+    the poll's total (category=None) row, response categories towards their
+    category's row, both in the hour the response arrived.
+    """
+    if 'created' in kwargs:
+        if not kwargs['created']:
+            return
+        delta = 1
+    else:
+        delta = -1
+
+    if sender is Response:
+        response, category_id = instance, None
+    else:
+        response, category_id = instance.response, instance.category_id
+    ResponseRollup.increment(response.poll_id, response.date, category_id, response.location_id, delta)
+
+def update_responder_sketches(sender, instance, **kwargs):
+    """
+    Adds a response's contact to the poll's responder sketch, and to its
+    category's sketch as the response is categorized, for the polls that
+    keep sketches.
+    """
+    if not kwargs['created']:
+        return
+    if sender is Response:
+        response, category_id = instance, None
+    else:
+        response, category_id = instance.response, instance.category_id
+    if not response.contact_id or not response.poll.approximate_reports:
+        return
+    ResponderSketch.add(response.poll_id, category_id, response.location_id, response.contact_id)
+
+post_save.connect(update_responder_sketches, sender=Response)
+post_save.connect(update_responder_sketches, sender=ResponseCategory)
+
+post_save.connect(update_response_rollups, sender=Response)
+post_delete.connect(update_response_rollups, sender=Response)
+post_save.connect(update_response_rollups, sender=ResponseCategory)
+post_delete.connect(update_response_rollups, sender=ResponseCategory)
+
+post_save.connect(bump_poll_data_version, sender=Response)
+post_delete.connect(bump_poll_data_version, sender=Response)
+post_save.connect(bump_poll_data_version, sender=ResponseCategory)
+post_delete.connect(bump_poll_data_version, sender=ResponseCategory)
+post_save.connect(bump_poll_data_version, sender=Category)
+post_delete.connect(bump_poll_data_version, sender=Category)
+
+
+class Responder(models.Model):
+    """
+    One row per contact that has responded to a poll, maintained alongside
+    Poll.responder_count as responses come and go.  The contact's reporting
+    location is captured when they first respond, for per-location rates.
+    """
+    poll = models.ForeignKey(Poll, related_name='responders')
+    contact = models.ForeignKey(Contact, related_name='poll_responders')
+    location = models.ForeignKey(Location, null=True, related_name='poll_responders')
+
+    class Meta:
+        unique_together = (('poll', 'contact'),)
+
+
+# the databases migration 0020 gives a unique index over the rollups that
+# treats a missing category or location as a value
+ROLLUP_UNIQUE_NULLS_VENDORS = ('postgresql', 'sqlite')
+
+
+class ResponseRollup(models.Model):
+    """
+    Hourly response counts per poll, category and location, maintained as
+    responses are categorized so that arrival curves can be charted without
+    scanning raw responses.  Rows with no category count every response to
+    the poll.  Rebuild a poll's rows with the backfill_poll_rollups command.
+    """
+    poll = models.ForeignKey(Poll, related_name='rollups')
+    hour = models.DateTimeField()
+    category = models.ForeignKey(Category, null=True, related_name='rollups')
+    location = models.ForeignKey(Location, null=True, related_name='poll_rollups')
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('poll', 'hour', 'category', 'location'),)
+
+    @staticmethod
+    def truncate(date):
+        return date.replace(minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def increment(cls, poll_id, date, category_id, location_id, delta=1):
+        hour = cls.truncate(date)
+        rollups = cls.objects.filter(poll=poll_id, hour=hour, category=category_id, location=location_id)
+        if rollups.update(count=F('count') + delta) or delta < 0:
+            return
+        if connection.vendor not in ROLLUP_UNIQUE_NULLS_VENDORS:
+            # NULLs never clash in the unique constraint, so without migration
+            # 0020's index first inserts take turns on the poll's row instead
+            list(Poll.all_objects.select_for_update().filter(pk=poll_id).values_list('pk', flat=True))
+            if rollups.update(count=F('count') + delta):
+                return
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(poll_id=poll_id, hour=hour, category_id=category_id, location_id=location_id,
+                               count=delta)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # somebody else created the row first
+            transaction.savepoint_rollback(sid)
+            rollups.update(count=F('count') + delta)
+
+    @classmethod
+    def rebuild(cls, poll):
+        """
+        Recomputes a poll's rollups from its raw responses.
+        """
+        counts = {}
+        for date, location_id in poll.responses.values_list('date', 'location').iterator():
+            key = (cls.truncate(date), None, location_id)
+            counts[key] = counts.get(key, 0) + 1
+        for date, category_id, location_id in ResponseCategory.objects.filter(response__poll=poll) \
+                .values_list('response__date', 'category', 'response__location').iterator():
+            key = (cls.truncate(date), category_id, location_id)
+            counts[key] = counts.get(key, 0) + 1
+
+        cls.objects.filter(poll=poll).delete()
+        cls.objects.bulk_create([
+            cls(poll=poll, hour=hour, category_id=category_id, location_id=location_id, count=count)
+            for (hour, category_id, location_id), count in counts.iteritems()])
+        return len(counts)
+
+
+class ResponderSketch(models.Model):
+    """
+    Sparse HyperLogLog registers estimating distinct responders per poll,
+    category and location, maintained as responses are categorized.  Rows
+    with no category cover every responder to the poll.  Rows with no
+    location are the poll-wide sketch, at PRECISION; each location keeps a
+    smaller one at LOCATION_PRECISION, so reading a location costs at most
+    2 ** LOCATION_PRECISION rows per category however many responded
+    there, and reading the whole poll at most 2 ** PRECISION.  Sketches
+    merge by taking each register's maximum rank, so any set of locations
+    can be combined with one grouped query.  Registers only ever grow:
+    deleted responses are still counted until the poll is rebuilt with the
+    backfill_poll_rollups command.
+    """
+    poll = models.ForeignKey(Poll, related_name='responder_sketches')
+    category = models.ForeignKey(Category, null=True, related_name='responder_sketches')
+    location = models.ForeignKey(Location, null=True, related_name='poll_responder_sketches')
+    register = models.PositiveSmallIntegerField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = (('poll', 'category', 'location', 'register'),)
+
+    @staticmethod
+    def positions(location_id, contact_id):
+        """
+        Returns the (location, register, rank) a contact sets: in the
+        poll-wide sketch, and in its location's if it has one.
+        """
+        positions = [(None,) + sketch_position(contact_id)]
+        if location_id is not None:
+            positions.append((location_id,) + sketch_position(contact_id, LOCATION_PRECISION))
+        return positions
+
+    @classmethod
+    def add(cls, poll_id, category_id, location_id, contact_id):
+        for sketch_location_id, register, rank in cls.positions(location_id, contact_id):
+            sketches = cls.objects.filter(poll=poll_id, category=category_id, location=sketch_location_id,
+                                          register=register)
+            if sketches.filter(rank__lt=rank).update(rank=rank) or sketches.exists():
+                continue
+            sid = transaction.savepoint()
+            try:
+                cls.objects.create(poll_id=poll_id, category_id=category_id, location_id=sketch_location_id,
+                                   register=register, rank=rank)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # somebody else created the register first
+                transaction.savepoint_rollback(sid)
+                sketches.filter(rank__lt=rank).update(rank=rank)
+
+    @classmethod
+    def rebuild(cls, poll):
+        """
+        Recomputes a poll's sketches from its raw responses, or drops them
+        if it doesn't keep any.
+        """
+        if not poll.approximate_reports:
+            cls.objects.filter(poll=poll).delete()
+            return 0
+        registers = {}
+
+        def add(category_id, location_id, contact_id):
+            for sketch_location_id, register, rank in cls.positions(location_id, contact_id):
+                key = (category_id, sketch_location_id, register)
+                registers[key] = max(registers.get(key, 0), rank)
+
+        for contact_id, location_id in poll.responses.exclude(contact=None) \
+                .values_list('contact', 'location').iterator():
+            add(None, location_id, contact_id)
+        for contact_id, category_id, location_id in ResponseCategory.objects \
+                .filter(response__poll=poll).exclude(response__contact=None) \
+                .values_list('response__contact', 'category', 'response__location').iterator():
+            add(category_id, location_id, contact_id)
+
+        cls.objects.filter(poll=poll).delete()
+        cls.objects.bulk_create([
+            cls(poll=poll, category_id=category_id, location_id=location_id, register=register, rank=rank)
+            for (category_id, location_id, register), rank in registers.iteritems()])
+        return len(registers)
+
+
 class Rule(models.Model):
     """
     A rule is a regular expression that an incoming message text might
@@ -836,6 +1678,190 @@ class Translation(models.Model):
         unique_together = ('field', 'language')
 
 
+class ExportJob(models.Model):
+    """
+    A background export of a poll's responses to a gzip-compressed file,
+    written by the run_export_job task.  Exports of ended polls are reused
+    for as long as the poll's data version doesn't change.
+    """
+    FORMAT_CSV = 'csv'
+    FORMAT_NDJSON = 'ndjson'
+    FORMAT_CHOICES = (
+        (FORMAT_CSV, _('CSV')),
+        (FORMAT_NDJSON, _('Newline-delimited JSON')),
+    )
+
+    STATUS_PENDING = 'p'
+    STATUS_RUNNING = 'r'
+    STATUS_DONE = 'd'
+    STATUS_FAILED = 'f'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _('Pending')),
+        (STATUS_RUNNING, _('Running')),
+        (STATUS_DONE, _('Done')),
+        (STATUS_FAILED, _('Failed')),
+    )
+
+    poll = models.ForeignKey(Poll, related_name='export_jobs')
+    user = models.ForeignKey(User, null=True)
+    format = models.CharField(max_length=6, choices=FORMAT_CHOICES, default=FORMAT_CSV)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    data_version = models.CharField(max_length=32, null=True)
+    rows_written = models.PositiveIntegerField(default=0)
+    total_rows = models.PositiveIntegerField(null=True)
+    file_path = models.CharField(max_length=255, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+
+    @classmethod
+    def request(cls, poll, format=FORMAT_CSV, user=None):
+        """
+        Returns an export job for the poll's current data, reusing a finished
+        export of an ended poll or a job already in flight where possible,
+        and queueing a new one otherwise.  Jobs in flight for longer than
+        EXPORT_JOB_TIMEOUT are marked failed instead of being waited on.
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=EXPORT_JOB_TIMEOUT)
+        cls.objects.filter(poll=poll, status__in=[cls.STATUS_PENDING, cls.STATUS_RUNNING], created__lt=cutoff) \
+            .update(status=cls.STATUS_FAILED)
+        version = get_data_version(poll.pk)
+        # with no version to tell whether the data has changed, nothing is reused
+        if version is not None:
+            version = str(version)
+            jobs = cls.objects.filter(poll=poll, format=format, data_version=version).order_by('-created')
+            if poll.end_date:
+                for job in jobs.filter(status=cls.STATUS_DONE):
+                    if job.file_path and os.path.exists(job.file_path):
+                        return job
+            for job in jobs.filter(status__in=[cls.STATUS_PENDING, cls.STATUS_RUNNING]):
+                return job
+
+        job = cls.objects.create(poll=poll, format=format, user=user, data_version=version)
+        run_export_job.delay(job.pk)
+        return job
+
+    @property
+    def is_done(self):
+        return self.status == ExportJob.STATUS_DONE
+
+    @property
+    def progress(self):
+        if self.is_done:
+            return 100.0
+        if not self.total_rows:
+            return 0.0
+        return min(self.rows_written * 100.0 / self.total_rows, 100.0)
+
+    def get_filename(self):
+        return "%s.%s.gz" % (self.poll.name, self.format)
+
+    def run(self):
+        from export import write_export
+
+        self.status = ExportJob.STATUS_RUNNING
+        try:
+            self.total_rows = self.poll.archive.response_count
+        except PollArchive.DoesNotExist:
+            self.total_rows = self.poll.responses.count()
+        self.save()
+        try:
+            self.file_path = write_export(self)
+        except Exception:
+            log.exception("[export-%d] export failed" % self.pk)
+            self.status = ExportJob.STATUS_FAILED
+        else:
+            self.status = ExportJob.STATUS_DONE
+        self.finished = datetime.datetime.now()
+        self.save()
+
+    def __unicode__(self):
+        return u'%s export of %s (%s)' % (self.format, self.poll.name, self.get_status_display())
+
+
+class ResultSnapshot(models.Model):
+    """
+    The frozen results of an ended poll: category tallies, numeric
+    aggregates, the per-location reports shown by view_report and the
+    demographic splits, serialized as one compact JSON document.  Report
+    views serve ended polls from it while no change has been counted since
+    it was built; the first change after a build queues a rebuild.
+    """
+    AGE_EDGES = [0, 18, 25, 35, 100]
+
+    poll = models.OneToOneField(Poll, related_name='result_snapshot')
+    # changes counted against the ended poll, and how many the results include
+    changes = models.PositiveIntegerField(default=0)
+    built_changes = models.IntegerField(default=0)
+    results = models.TextField()
+    created = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def mark_changed(cls, poll_pk):
+        snapshots = cls.objects.filter(poll=poll_pk)
+        if snapshots.filter(changes=F('built_changes')).update(changes=F('changes') + 1):
+            build_result_snapshot.delay(poll_pk)
+        else:
+            # already out of date, with its rebuild queued or running
+            snapshots.update(changes=F('changes') + 1)
+
+    @classmethod
+    def build(cls, poll):
+        # the row is there (and not current) before the reports are run, so
+        # that changes made while building are counted and not missed
+        snapshot, created = cls.objects.get_or_create(poll=poll, defaults={'built_changes': -1})
+        changes = cls.objects.filter(pk=snapshot.pk).values_list('changes', flat=True)[0]
+        db_type = Poll.TYPE_CHOICES.get(poll.type, {}).get('db_type')
+        results = {
+            'location_reports': {},
+            'demographics': poll.responses_by_demographics(cls.AGE_EDGES),
+        }
+        if db_type == Attribute.TYPE_FLOAT:
+            report_function = poll.get_numeric_report_data
+            results['numeric_details'] = [list(row) for row in poll.get_numeric_detailed_data()]
+        else:
+            report_function = poll.responses_by_category
+            results['categories'] = list(poll.responses_by_category())
+        for location in Location.tree.root_nodes():
+            results['location_reports'][str(location.pk)] = list(report_function(location=location, for_map=False))
+        if poll.is_yesno_poll():
+            results['gender'] = dict((gender, poll.responses_by_gender(gender)) for gender in ['M', 'F'])
+
+        snapshot.results = simplejson.dumps(results, cls=DjangoJSONEncoder, separators=(',', ':'))
+        snapshot.built_changes, snapshot.created = changes, datetime.datetime.now()
+        cls.objects.filter(pk=snapshot.pk).update(results=snapshot.results, built_changes=changes,
+                                                  created=snapshot.created)
+        snapshot.changes = cls.objects.filter(pk=snapshot.pk).values_list('changes', flat=True)[0]
+        if snapshot.changes != changes:
+            # changed while building, when the snapshot was already out of date
+            build_result_snapshot.delay(poll.pk)
+        return snapshot
+
+    def get_results(self):
+        return simplejson.loads(self.results)
+
+    def is_current(self):
+        return self.changes == self.built_changes
+
+    def __unicode__(self):
+        return u'results of %s' % self.poll.name
+
+
+class PollArchive(models.Model):
+    """
+    Where an archived poll's responses went: a gzipped file of one JSON
+    record per response, written before the rows were deleted from the hot
+    tables.  Its reports are served from the ResultSnapshot taken when it
+    was archived and its exports from the file, until it is restored.
+    """
+    poll = models.OneToOneField(Poll, related_name='archive')
+    file_path = models.CharField(max_length=255)
+    response_count = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'archive of %s' % self.poll.name
+
+
 def gettext_db(field, language):
     #if name exists in po file get it else look
     if Translation.objects.filter(field=field, language=language).exists():
@@ -864,3 +1890,31 @@ def send_messages_to_contacts(poll):
                                          status='Q', batch_status='Q')
             #localized_messages[language] = [messages, localized_contacts]
             poll.messages.add(*messages.values_list('pk', flat=True))
+
+
+@task
+def run_export_job(job_pk):
+    ExportJob.objects.get(pk=job_pk).run()
+
+
+@task
+def purge_poll(poll_pk):
+    from purge import purge_poll_rows
+    purge_poll_rows(Poll.all_objects.get(pk=poll_pk))
+
+
+@task
+def purge_category(category_pk):
+    from purge import purge_category_rows
+    purge_category_rows(Category.all_objects.get(pk=category_pk))
+
+
+@task
+def build_result_snapshot(poll_pk):
+    try:
+        poll = Poll.objects.get(pk=poll_pk)
+    except Poll.DoesNotExist:
+        # deleted since the build was queued
+        return
+    if not poll.is_archived():
+        ResultSnapshot.build(poll)
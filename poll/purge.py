@@ -0,0 +1,94 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from archive import delete_rows, remove_archive
+from eav_ids import get_content_type_id
+from models import Poll, Response, ResponseCategory, Responder, ResponseRollup, ResponderSketch, \
+    ResultSnapshot, ExportJob, PollArchive
+from report_cache import bump_data_version
+
+log = logging.getLogger(__name__)
+
+# number of rows deleted per transaction; small enough that each holds its
+# locks only briefly
+PURGE_CHUNK_SIZE = getattr(settings, 'POLL_PURGE_CHUNK_SIZE', 1000)
+
+
+def iter_id_chunks(queryset, chunk_size=PURGE_CHUNK_SIZE):
+    """
+    Yields the ids of a queryset's rows a chunk at a time, in id order,
+    the caller deleting each chunk before the next one is read.
+    """
+    last_pk = 0
+    while True:
+        ids = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return
+        yield ids
+        last_pk = ids[-1]
+
+
+def purge_responses(poll, chunk_size=PURGE_CHUNK_SIZE):
+    """
+    Deletes a poll's responses with their categorizations and values.  The
+    rows are deleted in SQL, skipping the signal handlers, whose counters
+    and rollups go with the poll.
+    """
+    entity_ct = get_content_type_id(Response)
+    deleted = 0
+    for ids in iter_id_chunks(Response.objects.filter(poll=poll), chunk_size):
+        def delete_chunk():
+            delete_rows('eav_value', 'entity_id', ids, ' AND entity_ct_id = %s', [entity_ct])
+            delete_rows('poll_responsecategory', 'response_id', ids)
+            delete_rows('poll_response', 'id', ids)
+        transaction.commit_on_success(delete_chunk)()
+        deleted += len(ids)
+        log.info("[purge-poll-%d] %d responses deleted" % (poll.pk, deleted))
+
+
+def purge_queryset(queryset, chunk_size=PURGE_CHUNK_SIZE):
+    for ids in iter_id_chunks(queryset, chunk_size):
+        transaction.commit_on_success(lambda: queryset.model.objects.filter(pk__in=ids).delete())()
+
+
+def purge_poll_rows(poll, chunk_size=PURGE_CHUNK_SIZE):
+    """
+    Deletes a soft-deleted poll a chunk at a time: its responses, then the
+    per-poll bookkeeping and its contact and message links, and finally
+    the poll, by which time only its categories and rules are left for
+    Django to collect.
+    """
+    purge_responses(poll, chunk_size)
+    for model in [Responder, ResponseRollup, ResponderSketch, ResultSnapshot, ExportJob]:
+        purge_queryset(model.objects.filter(poll=poll), chunk_size)
+        log.info("[purge-poll-%d] %s rows deleted" % (poll.pk, model.__name__))
+    for through in [Poll.contacts.through, Poll.messages.through]:
+        purge_queryset(through.objects.filter(poll=poll), chunk_size)
+        log.info("[purge-poll-%d] %s rows deleted" % (poll.pk, through.__name__))
+
+    try:
+        archive = PollArchive.objects.get(poll=poll)
+    except PollArchive.DoesNotExist:
+        pass
+    else:
+        remove_archive(archive)
+    transaction.commit_on_success(poll.delete)()
+    log.info("[purge-poll-%d] done" % poll.pk)
+
+
+def purge_category_rows(category, chunk_size=PURGE_CHUNK_SIZE):
+    """
+    Deletes a soft-deleted category's categorizations a chunk at a time and
+    then the category.  The rows are deleted in SQL: the only rollups their
+    signal handlers would touch are the category's own, which go with it.
+    """
+    deleted = 0
+    for ids in iter_id_chunks(ResponseCategory.objects.filter(category=category), chunk_size):
+        transaction.commit_on_success(lambda: delete_rows('poll_responsecategory', 'id', ids))()
+        deleted += len(ids)
+        log.info("[purge-category-%d] %d categorizations deleted" % (category.pk, deleted))
+    transaction.commit_on_success(category.delete)()
+    bump_data_version(category.poll_id)
+    log.info("[purge-category-%d] done" % category.pk)
@@ -0,0 +1,124 @@
+"""
+Sends the reads of the reporting views to a replica database.  Add the
+router to the project's settings and name the replica's alias:
+
+    DATABASE_ROUTERS = ['poll.replica.ReportRouter']
+    POLL_REPORT_DATABASE = 'replica'
+
+Reads made inside reading_reports() (the views decorated with
+report_reads) then go to the replica, and writes to the primary as ever;
+without the router every read goes to the primary.  Replication lags, so
+for a while after a user edits a poll their own reports are read from the
+primary (see pin_to_primary), and reports read from the replica in that
+window aren't cached (see report_cache.reads_are_current).
+
+The report functions take no `using` argument: a router also sends the
+reads they don't spell out to the replica (related objects, the eav values
+and attributes, the location tree), where passing an alias down would
+leave those on the primary, reading a mix of the two databases.  Only the
+streamed exports take `using`, as they outlive the view that starts them.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# the alias reporting reads go to; unset, or not in DATABASES, means the primary
+REPORT_DATABASE = getattr(settings, 'POLL_REPORT_DATABASE', None)
+
+# for how long after an edit the editor's reports are read from the primary,
+# which should cover the replica's lag
+PRIMARY_PIN_SECONDS = getattr(settings, 'POLL_PRIMARY_PIN_SECONDS', 30)
+
+ROUTER_PATH = 'poll.replica.ReportRouter'
+
+PIN_SESSION_KEY = 'poll_primary_until'
+
+_state = threading.local()
+
+
+def pin_to_primary(req):
+    session = getattr(req, 'session', None)
+    if session is not None:
+        session[PIN_SESSION_KEY] = time.time() + PRIMARY_PIN_SECONDS
+
+
+def report_database(req=None):
+    """
+    Returns the alias a request's reports should be read from.
+    """
+    if not REPORT_DATABASE or REPORT_DATABASE not in settings.DATABASES \
+            or ROUTER_PATH not in getattr(settings, 'DATABASE_ROUTERS', []):
+        return DEFAULT_DB_ALIAS
+    session = getattr(req, 'session', None)
+    if session is not None and session.get(PIN_SESSION_KEY, 0) > time.time():
+        return DEFAULT_DB_ALIAS
+    return REPORT_DATABASE
+
+
+def current_report_database():
+    """
+    Returns the alias the reads being made now go to.
+    """
+    return getattr(_state, 'database', None) or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def reading_reports(req=None):
+    previous = getattr(_state, 'database', None)
+    _state.database = report_database(req)
+    try:
+        yield _state.database
+    finally:
+        _state.database = previous
+
+
+def report_reads(view):
+    """
+    Decorator for the reporting views: their reads go to the report database.
+    """
+    @wraps(view)
+    def _wrapped(req, *args, **kwargs):
+        with reading_reports(req):
+            return view(req, *args, **kwargs)
+    return _wrapped
+
+
+def pins_primary(view):
+    """
+    Decorator for the editing views: after a POST, the user's reports are
+    read from the primary for PRIMARY_PIN_SECONDS, so they see their edit.
+    """
+    @wraps(view)
+    def _wrapped(req, *args, **kwargs):
+        response = view(req, *args, **kwargs)
+        if req.method == 'POST':
+            pin_to_primary(req)
+        return response
+    return _wrapped
+
+
+class ReportRouter(object):
+
+    def db_for_read(self, model, **hints):
+        return getattr(_state, 'database', None)
+
+    def db_for_write(self, model, **hints):
+        # an object read from the replica is still saved to the primary
+        instance = hints.get('instance')
+        if instance is not None and REPORT_DATABASE and instance._state.db == REPORT_DATABASE:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if REPORT_DATABASE and set([obj1._state.db, obj2._state.db]) <= set([DEFAULT_DB_ALIAS, REPORT_DATABASE]):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if REPORT_DATABASE and db == REPORT_DATABASE and db != DEFAULT_DB_ALIAS:
+            return False
+        return None
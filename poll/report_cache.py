@@ -0,0 +1,109 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+
+from cache_versions import VERSION_TIMEOUT, get_version, bump_version
+from replica import PRIMARY_PIN_SECONDS, report_database
+
+# how long serialized report payloads are kept around; they are keyed on the
+# poll's data version, so stale entries are simply never read again
+REPORT_CACHE_TIMEOUT = getattr(settings, 'POLL_REPORT_CACHE_TIMEOUT', 60 * 60)
+
+def _version_key(poll_pk):
+    return 'poll:%s:data_version' % poll_pk
+
+
+def _changed_key(poll_pk):
+    return 'poll:%s:data_changed' % poll_pk
+
+
+def _payload_key(digest):
+    return 'poll:report:%s' % digest
+
+
+def get_data_version(poll_pk):
+    """
+    Returns the current data version for a poll.  This is the only lookup
+    needed to decide whether a cached report (or a client's ETag) is current.
+    """
+    return get_version(_version_key(poll_pk))
+
+
+def bump_data_version(poll_pk):
+    """
+    Invalidates every cached report for a poll, called whenever one of its
+    responses or categories changes.
+    """
+    bump_version(_version_key(poll_pk))
+    cache.set(_changed_key(poll_pk), time.time(), VERSION_TIMEOUT)
+
+
+def reads_are_current(poll_pk, database):
+    """
+    Whether reports read from a database can be cached under a poll's
+    current data version: always for the primary, and for the replica once
+    the poll has been unchanged for longer than the replica lags.
+    """
+    if database == DEFAULT_DB_ALIAS:
+        return True
+    changed = cache.get(_changed_key(poll_pk))
+    return changed is None or changed < time.time() - PRIMARY_PIN_SECONDS
+
+
+def etag_matches(req, etag):
+    if_none_match = req.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+
+def cached_report(endpoint):
+    """
+    Decorator for the JSON report views (stats, age_stats, etc.).  The
+    serialized payload is cached per (poll, endpoint, params, data version)
+    and served with an ETag, so a client polling an unchanged poll gets a
+    304 without any report query being run.  A report read from a replica
+    that may not have caught up with the version, or built while the cache
+    keeps no version, is neither cached nor tagged.
+    """
+    def decorator(view):
+        @wraps(view)
+        def _wrapped(req, poll_id, *args, **kwargs):
+            version = get_data_version(poll_id)
+            if version is None:
+                response = view(req, poll_id, *args, **kwargs)
+                patch_cache_control(response, must_revalidate=True, max_age=0)
+                return response
+            params = (sorted(req.GET.items()), args, sorted(kwargs.items()))
+            digest = hashlib.md5(repr((endpoint, int(poll_id), params, version))).hexdigest()
+            etag = '"%s"' % digest
+
+            if etag_matches(req, etag):
+                response = HttpResponseNotModified()
+            else:
+                payload = cache.get(_payload_key(digest))
+                if payload is None:
+                    response = view(req, poll_id, *args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                    if not reads_are_current(poll_id, report_database(req)):
+                        patch_cache_control(response, must_revalidate=True, max_age=0)
+                        return response
+                    cache.set(_payload_key(digest), (response.content, response['Content-Type']),
+                              REPORT_CACHE_TIMEOUT)
+                else:
+                    content, content_type = payload
+                    response = HttpResponse(content, content_type=content_type)
+
+            response['ETag'] = etag
+            patch_cache_control(response, must_revalidate=True, max_age=0)
+            return response
+        return _wrapped
+    return decorator
@@ -0,0 +1,84 @@
+import datetime
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.contrib.auth.models import User
+from rapidsms.models import Contact, Backend, Connection
+from rapidsms_httprouter.models import Message
+
+from poll.models import Poll, Response, PollArchive
+from poll import archive, views
+from poll.archive import archive_poll, restore_poll, polls_to_archive
+from poll.export import iter_csv_rows
+
+
+class TestArchive(TestCase):
+
+    def setUp(self):
+        self.archive_root = tempfile.mkdtemp()
+        self.old_archive_root, archive.ARCHIVE_ROOT = archive.ARCHIVE_ROOT, self.archive_root
+
+        self.user = User.objects.create(username='archiver', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='archive poll', question='are you archived?', user=self.user,
+                                        type=Poll.TYPE_TEXT)
+        self.poll.add_yesno_categories()
+        backend = Backend.objects.create(name='archive')
+        contact = Contact.objects.create(name='archived contact')
+        self.connection = Connection.objects.create(identity='0794000031', backend=backend, contact=contact)
+
+    def tearDown(self):
+        archive.ARCHIVE_ROOT = self.old_archive_root
+        shutil.rmtree(self.archive_root)
+
+    def respond(self, text):
+        message = Message.objects.create(connection=self.connection, text=text, direction='I', status='H')
+        return self.poll.process_response(message)[0]
+
+    def test_polls_to_archive(self):
+        self.poll.end_date = datetime.datetime.now() - datetime.timedelta(days=10)
+        self.poll.save()
+        self.assertEqual(list(polls_to_archive(days=30)), [])
+        self.assertEqual(list(polls_to_archive(days=5)), [self.poll])
+
+    def test_archive_and_restore(self):
+        yes = self.respond('yes')
+        no = self.respond('no')
+        self.poll.end_date = datetime.datetime.now()
+        self.poll.save()
+        rows = list(iter_csv_rows(self.poll))
+        categories = sorted((c['category__name'], c['value']) for c in self.poll.responses_by_category())
+
+        archive_poll(self.poll, chunk_size=1)
+        self.assertTrue(self.poll.is_archived())
+        self.assertEqual(PollArchive.objects.get(poll=self.poll).response_count, 2)
+        self.assertEqual(self.poll.responses.count(), 0)
+        self.assertEqual(self.poll.response_count, 2)
+
+        # exports read the archive and reports its snapshot
+        self.assertEqual(list(iter_csv_rows(self.poll)), rows)
+        snapshot = self.poll.get_result_snapshot()
+        self.assertEqual(sorted((c['category__name'], c['value']) for c in snapshot['categories']), categories)
+
+        restore_poll(self.poll, chunk_size=1)
+        self.assertFalse(self.poll.is_archived())
+        restored = Response.objects.get(pk=yes.pk)
+        self.assertEqual(restored.date, yes.date)
+        self.assertEqual(restored.poll_text_value, 'yes')
+        self.assertEqual(list(restored.categories.values_list('category__name', flat=True)), [u'yes'])
+        self.assertEqual(Response.objects.get(pk=no.pk).message_id, no.message_id)
+        self.assertEqual(list(iter_csv_rows(self.poll)), rows)
+
+    def test_reports_the_snapshot_does_not_cover_are_refused(self):
+        self.respond('yes')
+        self.poll.end_date = datetime.datetime.now()
+        self.poll.save()
+        archive_poll(self.poll)
+
+        factory = RequestFactory()
+        self.assertEqual(views.stats(factory.get('/'), str(self.poll.pk)).status_code, 200)
+        response = views.age_stats(factory.get('/', {'lower': 0, 'upper': 100}), str(self.poll.pk))
+        self.assertEqual(response.status_code, 409)
+        response = views.demographic_stats(factory.get('/', {'edges': '0,50,100'}), str(self.poll.pk))
+        self.assertEqual(response.status_code, 409)
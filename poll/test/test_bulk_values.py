@@ -0,0 +1,52 @@
+from django.core.management import call_command
+from django.test import TestCase
+from django.contrib.auth.models import User
+from rapidsms.contrib.locations.models import Location, LocationType
+
+from poll import models as poll_models, bulk_values
+from poll.models import Poll, Response
+from poll.bulk_values import write_response_values
+from poll.report_cache import get_data_version
+
+
+class TestBulkValues(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='bulk', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='bulk poll', question='how many?', user=user,
+                                        type=Poll.TYPE_NUMERIC)
+        self.responses = [Response.objects.create(poll=self.poll) for i in range(3)]
+
+    def values(self, slug):
+        return [getattr(Response.objects.get(pk=r.pk), slug) for r in self.responses]
+
+    def test_writes_updates_and_clears(self):
+        first, second, third = self.responses
+        write_response_values([(first, 'poll_number_value', 1.0), (second.pk, 'poll_number_value', 2.0)])
+        self.assertEqual(self.values('poll_number_value'), [1.0, 2.0, None])
+
+        version = get_data_version(self.poll.pk)
+        write_response_values([(first, 'poll_number_value', 5.0), (second, 'poll_number_value', None),
+                               (third, 'poll_number_value', 3.0), (third, 'poll_text_value', '3')],
+                              chunk_size=2)
+        self.assertEqual(self.values('poll_number_value'), [5.0, None, 3.0])
+        self.assertEqual(self.values('poll_text_value'), [None, None, '3'])
+        self.assertNotEqual(get_data_version(self.poll.pk), version)
+
+    def test_location_values(self):
+        district = LocationType.objects.create(name='district', slug='district')
+        kampala = Location.objects.create(name='Kampala', type=district)
+        write_response_values([(self.responses[0], 'poll_location_value', kampala),
+                               (self.responses[1], 'poll_location_value', kampala.pk)])
+        self.assertEqual(self.values('poll_location_value'), [kampala, kampala, None])
+
+    def test_native_values_are_copied_back_to_eav(self):
+        Response.objects.filter(pk=self.responses[0].pk).update(number_value=4.0)
+        storage = poll_models.VALUE_STORAGE, bulk_values.VALUE_STORAGE
+        poll_models.VALUE_STORAGE = bulk_values.VALUE_STORAGE = poll_models.VALUE_STORAGE_DUAL
+        try:
+            call_command('backfill_eav_values', p=str(self.poll.pk))
+        finally:
+            poll_models.VALUE_STORAGE, bulk_values.VALUE_STORAGE = storage
+        self.assertEqual([Response.objects.get(pk=r.pk).eav.poll_number_value for r in self.responses],
+                         [4.0, None, None])
@@ -0,0 +1,68 @@
+import datetime
+import unittest
+
+from django.test import TestCase
+from django.contrib.auth.models import User
+from dateutil.relativedelta import relativedelta
+from rapidsms.models import Contact, Backend, Connection
+from rapidsms.contrib.locations.models import Location, LocationType
+from rapidsms_httprouter.models import Message
+
+from poll.models import Poll
+from poll.columnar import numpy
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestColumnarEngine(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='columnar', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='columnar poll', question='are you columnar?', user=self.user,
+                                        type=Poll.TYPE_TEXT)
+        self.poll.add_yesno_categories()
+        district = LocationType.objects.create(name='district', slug='district')
+        self.country = Location.objects.create(name='Uganda', type=district)
+        kampala = Location.objects.create(name='Kampala', type=district, parent=self.country)
+        gulu = Location.objects.create(name='Gulu', type=district, parent=self.country)
+        self.country = Location.objects.get(pk=self.country.pk)
+
+        backend = Backend.objects.create(name='columnar')
+        self.connections = []
+        for identity, gender, age, location in [('0794000021', 'M', 20, kampala),
+                                                ('0794000022', 'F', 30, gulu),
+                                                ('0794000023', 'F', 40, None)]:
+            contact = Contact.objects.create(name=identity, gender=gender, reporting_location=location,
+                                             birthdate=datetime.datetime.now() - relativedelta(years=age))
+            self.connections.append(Connection.objects.create(identity=identity, backend=backend,
+                                                              contact=contact))
+
+    def respond(self, connection, text):
+        message = Message.objects.create(connection=connection, text=text, direction='I', status='H')
+        return self.poll.process_response(message)[0]
+
+    def test_engines_agree(self):
+        self.respond(self.connections[0], 'yes')
+        self.respond(self.connections[1], 'no')
+        self.respond(self.connections[1], 'yes')
+        self.respond(self.connections[2], 'no')
+
+        columnar = Poll.ENGINE_COLUMNAR
+        self.assertEqual(sorted(self.poll.responses_by_gender('F', engine=columnar)),
+                         sorted(self.poll.responses_by_gender('F')))
+        self.assertEqual(sorted(self.poll.responses_by_age(25, 45, engine=columnar)),
+                         sorted(self.poll.responses_by_age(25, 45)))
+
+        def counts(rows):
+            return sorted((r.get('location_id'), r['category__name'], r['value']) for r in rows)
+        self.assertEqual(counts(self.poll.responses_by_category(engine=columnar)),
+                         counts(self.poll.responses_by_category()))
+        self.assertEqual(counts(self.poll.responses_by_category(self.country, for_map=False, engine=columnar)),
+                         counts(self.poll.responses_by_category(self.country, for_map=False)))
+
+    def test_columns_reload_when_data_changes(self):
+        self.respond(self.connections[0], 'yes')
+        columns = self.poll.get_response_columns()
+        self.assertTrue(self.poll.get_response_columns() is columns)
+
+        self.respond(self.connections[0], 'no')
+        self.assertEqual(len(self.poll.get_response_columns()), 2)
@@ -0,0 +1,50 @@
+import threading
+import unittest
+
+from django.db import connection
+from django.test import TransactionTestCase
+from django.contrib.auth.models import User
+from rapidsms.models import Contact, Backend, Connection
+from rapidsms_httprouter.router import get_router
+
+from poll.models import Poll
+
+
+@unittest.skipUnless(connection.features.has_select_for_update,
+                     "needs a database with row locks (SELECT ... FOR UPDATE)")
+class TestConcurrentResponses(TransactionTestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='racer', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='race poll', question='are you racing?', user=user,
+                                        type=Poll.TYPE_TEXT, response_type=Poll.RESPONSE_TYPE_ONE)
+        self.poll.add_yesno_categories()
+        contact = Contact.objects.create(name='racer')
+        self.backend = Backend.objects.create(name='race')
+        self.connection = Connection.objects.create(identity='0794000051', backend=self.backend, contact=contact)
+        self.poll.contacts.add(contact)
+        self.poll.start()
+
+    def send_in_parallel(self, texts):
+        router = get_router()
+        errors = []
+
+        def send(text):
+            try:
+                router.handle_incoming(self.backend.name, self.connection.identity, text)
+            except Exception, e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=send, args=(text,)) for text in texts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_one_response_survives_parallel_replies(self):
+        for attempt in range(5):
+            self.send_in_parallel(['yes', 'no', 'yes', 'no', 'yes', 'no', 'yes', 'no'])
+            self.assertEqual(self.poll.responses.filter(contact=self.connection.contact).count(), 1)
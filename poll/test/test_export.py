@@ -0,0 +1,129 @@
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.contrib.auth.models import User
+from rapidsms.models import Contact, Backend, Connection
+from rapidsms_httprouter.models import Message
+
+from poll.models import Poll, ExportJob
+from poll import export, models
+from poll.export import iter_csv_rows, stream_csv
+from poll.report_cache import get_data_version
+
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='exporter', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='export poll', question='are you exported?', user=self.user,
+                                        type=Poll.TYPE_TEXT)
+        self.poll.add_yesno_categories()
+        backend = Backend.objects.create(name='export')
+        self.contact = Contact.objects.create(name='exported contact')
+        self.connection = Connection.objects.create(identity='0794000001', backend=backend, contact=self.contact)
+        self.anonymous_connection = Connection.objects.create(identity='0794000002', backend=backend)
+
+    def respond(self, connection, text):
+        message = Message.objects.create(connection=connection, text=text, direction='I', status='H')
+        return self.poll.process_response(message)[0]
+
+
+class TestCsvExport(ExportTestCase):
+
+    def test_rows_match_csv_template_layout(self):
+        self.respond(self.connection, 'yes')
+        self.respond(self.anonymous_connection, 'no')
+
+        rows = list(iter_csv_rows(self.poll, chunk_size=1))
+        self.assertEqual(len(rows), 2)
+
+        # newest first, as the template export was
+        self.assertEqual(rows[0][0], '0794000002')
+        self.assertEqual(rows[0][2], 'no')
+        self.assertEqual(rows[0][3], 'no,')
+        self.assertEqual(rows[1][0], 'exported contact')
+        self.assertEqual(rows[1][3], 'yes,')
+
+    def test_queries_do_not_grow_with_responses(self):
+        for i in range(5):
+            self.respond(self.connection, 'yes')
+
+        # the archive check, then one chunk: responses, eav values, categories,
+        # then the empty chunk
+        self.assertNumQueries(5, lambda: list(stream_csv(self.poll, chunk_size=10)))
+
+
+class TestExportJobs(ExportTestCase):
+
+    def setUp(self):
+        super(TestExportJobs, self).setUp()
+        self.old_export_root = export.EXPORT_ROOT
+        export.EXPORT_ROOT = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(export.EXPORT_ROOT)
+        export.EXPORT_ROOT = self.old_export_root
+
+    def test_job_writes_compressed_export(self):
+        self.respond(self.connection, 'yes')
+        self.respond(self.connection, 'no')
+
+        job = ExportJob.objects.create(poll=self.poll, format=ExportJob.FORMAT_CSV)
+        job.run()
+
+        job = ExportJob.objects.get(pk=job.pk)
+        self.assertTrue(job.is_done)
+        self.assertEqual(job.rows_written, 2)
+        self.assertEqual(job.progress, 100.0)
+        lines = gzip.open(job.file_path).read().splitlines()
+        self.assertEqual(lines[0], '"sender","time","value","categories"')
+        self.assertEqual(len(lines), 3)
+
+    def test_ended_poll_export_is_reused(self):
+        self.respond(self.connection, 'yes')
+        self.poll.end()
+
+        job = ExportJob.objects.create(poll=self.poll, format=ExportJob.FORMAT_NDJSON,
+                                       data_version=str(get_data_version(self.poll.pk)))
+        job.run()
+        self.assertEqual(ExportJob.request(self.poll, format=ExportJob.FORMAT_NDJSON).pk, job.pk)
+
+
+    def test_failed_job_leaves_no_partial_file(self):
+        self.respond(self.connection, 'yes')
+        old_iter_ndjson_lines = export.iter_ndjson_lines
+
+        def failing_lines(poll, chunk_size):
+            yield '{}\n'
+            raise IOError("disk full")
+        export.iter_ndjson_lines = failing_lines
+        try:
+            job = ExportJob.objects.create(poll=self.poll, format=ExportJob.FORMAT_NDJSON)
+            job.run()
+        finally:
+            export.iter_ndjson_lines = old_iter_ndjson_lines
+
+        job = ExportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, ExportJob.STATUS_FAILED)
+        self.assertEqual(job.rows_written, 1)
+        self.assertEqual(os.listdir(export.EXPORT_ROOT), [])
+
+    def test_abandoned_job_is_not_reused(self):
+        version = str(get_data_version(self.poll.pk))
+        abandoned = ExportJob.objects.create(poll=self.poll, data_version=version, status=ExportJob.STATUS_RUNNING)
+        self.assertEqual(ExportJob.request(self.poll).pk, abandoned.pk)
+
+        ExportJob.objects.filter(pk=abandoned.pk).update(created=datetime.datetime(2000, 1, 1))
+        old_delay, queued = models.run_export_job.delay, []
+        models.run_export_job.delay = queued.append
+        try:
+            job = ExportJob.request(self.poll)
+        finally:
+            models.run_export_job.delay = old_delay
+        self.assertNotEqual(job.pk, abandoned.pk)
+        self.assertEqual(queued, [job.pk])
+        self.assertEqual(ExportJob.objects.get(pk=abandoned.pk).status, ExportJob.STATUS_FAILED)
@@ -0,0 +1,29 @@
+from django.test import TestCase
+from rapidsms.contrib.locations.models import Location, LocationType
+
+from poll.location_index import get_location_index
+
+
+class TestLocationIndex(TestCase):
+
+    def setUp(self):
+        self.district = LocationType.objects.create(name='district', slug='district')
+        self.uganda = Location.objects.create(name='Uganda', type=self.district)
+        self.kampala = Location.objects.create(name='Kampala', type=self.district, parent=self.uganda)
+        self.gulu = Location.objects.create(name='Gulu', type=self.district, parent=self.uganda)
+        self.nakawa = Location.objects.create(name='Nakawa', type=self.district, parent=self.kampala)
+
+    def test_children_and_ancestors(self):
+        index = get_location_index()
+        self.assertEqual(sorted(n.name for n in index.children(self.uganda.pk)), ['Gulu', 'Kampala'])
+        self.assertEqual(index.children(self.gulu.pk), [])
+        self.assertEqual(index.ancestor_at_level(self.nakawa.pk, 1).pk, self.kampala.pk)
+        self.assertEqual(index.ancestor_at_level(self.nakawa.pk, 0).pk, self.uganda.pk)
+        self.assertEqual(index.ancestor_at_level(self.uganda.pk, 1), None)
+
+    def test_index_is_rebuilt_when_locations_change(self):
+        index = get_location_index()
+        self.assertTrue(get_location_index() is index)
+
+        Location.objects.create(name='Kawempe', type=self.district, parent=self.kampala)
+        self.assertEqual(len(get_location_index().children(self.kampala.pk)), 2)
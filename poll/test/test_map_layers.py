@@ -0,0 +1,55 @@
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.contrib.auth.models import User
+from django.utils import simplejson
+from rapidsms.models import Contact, Backend, Connection
+from rapidsms.contrib.locations.models import Location, LocationType, Point
+from rapidsms_httprouter.models import Message
+
+from poll.models import Poll
+from poll.map_layers import build_category_layer, get_map_layer, decompress
+from poll.views import map_layer
+
+
+class TestMapLayers(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='mapper', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='mapped poll', question='are you mapped?', user=self.user,
+                                        type=Poll.TYPE_TEXT)
+        self.poll.add_yesno_categories()
+        district = LocationType.objects.create(name='district', slug='district')
+        point = Point.objects.create(latitude='0.3136111111', longitude='32.5811111111')
+        self.kampala = Location.objects.create(name='Kampala', type=district, point=point)
+        contact = Contact.objects.create(name='mapped contact', reporting_location=self.kampala)
+        backend = Backend.objects.create(name='mapper')
+        self.connection = Connection.objects.create(identity='0794000011', backend=backend, contact=contact)
+
+    def respond(self, text):
+        message = Message.objects.create(connection=self.connection, text=text, direction='I', status='H')
+        return self.poll.process_response(message)[0]
+
+    def test_layer_is_geojson_with_rounded_points(self):
+        self.respond('yes')
+        self.respond('yes')
+        self.respond('whatever')
+
+        layer = build_category_layer(self.poll, self.kampala.level)
+        self.assertEqual(layer['type'], 'FeatureCollection')
+        self.assertEqual(len(layer['features']), 1)
+        feature = layer['features'][0]
+        self.assertEqual(feature['geometry'], {'type': 'Point', 'coordinates': [32.58111, 0.31361]})
+        self.assertEqual(feature['properties']['total'], 3)
+        counts = dict((c['name'], c['value']) for c in feature['properties']['categories'])
+        self.assertEqual(counts[u'yes'], 2)
+
+    def test_layer_is_served_gzipped_and_reused(self):
+        self.respond('no')
+        version, payload = get_map_layer(self.poll, self.kampala.level)
+        self.assertNumQueries(0, lambda: get_map_layer(self.poll, self.kampala.level))
+
+        response = map_layer(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip, deflate'),
+                             poll_id=str(self.poll.pk), level=str(self.kampala.level))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        data = simplejson.loads(decompress(response.content))
+        self.assertEqual(data['features'][0]['properties']['total'], 1)
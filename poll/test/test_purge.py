@@ -0,0 +1,50 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from rapidsms.models import Contact, Backend, Connection
+from rapidsms_httprouter.models import Message
+from eav.models import Value
+
+from poll.models import Poll, Category, Response, ResponseCategory, ResponseRollup
+from poll.purge import purge_poll_rows, purge_category_rows
+
+
+class TestPurge(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='purger', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='purge poll', question='are you purged?', user=self.user,
+                                        type=Poll.TYPE_TEXT)
+        self.poll.add_yesno_categories()
+        backend = Backend.objects.create(name='purge')
+        self.connections = []
+        for identity in ['0794000041', '0794000042', '0794000043']:
+            contact = Contact.objects.create(name=identity)
+            self.poll.contacts.add(contact)
+            self.connections.append(Connection.objects.create(identity=identity, backend=backend, contact=contact))
+        for connection, text in zip(self.connections, ['yes', 'no', 'yes']):
+            message = Message.objects.create(connection=connection, text=text, direction='I', status='H')
+            self.poll.process_response(message)
+
+    def test_purge_poll(self):
+        Poll.all_objects.filter(pk=self.poll.pk).update(deleted=True)
+        self.assertFalse(Poll.objects.filter(pk=self.poll.pk).exists())
+
+        response_ids = list(self.poll.responses.values_list('pk', flat=True))
+        purge_poll_rows(self.poll, chunk_size=2)
+        self.assertFalse(Poll.all_objects.filter(pk=self.poll.pk).exists())
+        self.assertFalse(Response.objects.filter(pk__in=response_ids).exists())
+        self.assertFalse(Value.objects.filter(entity_id__in=response_ids).exists())
+        self.assertFalse(ResponseRollup.objects.filter(poll=self.poll).exists())
+
+    def test_purge_category(self):
+        yes = self.poll.categories.get(name='yes')
+        Category.all_objects.filter(pk=yes.pk).update(deleted=True)
+        self.assertEqual(list(Category.objects.filter(poll=self.poll).values_list('name', flat=True)), [u'no'])
+        # until the purge runs, its responses count as uncategorized
+        self.assertEqual([(c['category__name'], c['value']) for c in self.poll.responses_by_category()],
+                         [(u'no', 1), ('uncategorized', 2)])
+
+        purge_category_rows(yes, chunk_size=1)
+        self.assertFalse(Category.all_objects.filter(pk=yes.pk).exists())
+        self.assertEqual(ResponseCategory.objects.filter(response__poll=self.poll).count(), 1)
+        self.assertEqual(self.poll.responses.count(), 3)
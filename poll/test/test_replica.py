@@ -0,0 +1,128 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connection, connections, router
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import simplejson
+from rapidsms.models import Contact, Backend, Connection
+from rapidsms_httprouter.models import Message
+
+from poll import replica
+from poll.models import Poll
+from poll.replica import ReportRouter, reading_reports, report_database, pin_to_primary
+from poll.views import stats
+
+
+class TestReportRouting(TestCase):
+
+    def setUp(self):
+        self.old_report_database, replica.REPORT_DATABASE = replica.REPORT_DATABASE, 'replica'
+        self.added_alias = 'replica' not in settings.DATABASES
+        if self.added_alias:
+            settings.DATABASES['replica'] = dict(settings.DATABASES[DEFAULT_DB_ALIAS])
+        self.old_routers = getattr(settings, 'DATABASE_ROUTERS', [])
+        settings.DATABASE_ROUTERS = list(self.old_routers) + [replica.ROUTER_PATH]
+        self.req = RequestFactory().get('/')
+        self.req.session = {}
+
+    def tearDown(self):
+        replica.REPORT_DATABASE = self.old_report_database
+        settings.DATABASE_ROUTERS = self.old_routers
+        if self.added_alias:
+            del settings.DATABASES['replica']
+
+    def test_reports_read_from_the_replica(self):
+        router = ReportRouter()
+        self.assertEqual(router.db_for_read(Poll), None)
+        with reading_reports(self.req):
+            self.assertEqual(router.db_for_read(Poll), 'replica')
+            self.assertEqual(router.db_for_write(Poll), None)
+        self.assertEqual(router.db_for_read(Poll), None)
+
+    def test_editors_are_pinned_to_the_primary(self):
+        self.assertEqual(report_database(self.req), 'replica')
+        pin_to_primary(self.req)
+        self.assertEqual(report_database(self.req), DEFAULT_DB_ALIAS)
+        self.req.session[replica.PIN_SESSION_KEY] = time.time() - 1
+        self.assertEqual(report_database(self.req), 'replica')
+
+    def test_unconfigured_replica_falls_back_to_the_primary(self):
+        replica.REPORT_DATABASE = 'missing'
+        self.assertEqual(report_database(self.req), DEFAULT_DB_ALIAS)
+
+    def test_no_router_reads_from_the_primary(self):
+        settings.DATABASE_ROUTERS = self.old_routers
+        self.assertEqual(report_database(self.req), DEFAULT_DB_ALIAS)
+
+
+def copy_sqlite_database(source, target):
+    """
+    Creates the source's tables in the target and copies their rows over,
+    the target then standing for a replica that stopped replicating.
+    """
+    cursor, target_cursor = source.cursor(), target.cursor()
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'")
+    for name, sql in cursor.fetchall():
+        if name.startswith('sqlite_'):
+            continue
+        target_cursor.execute(sql)
+        cursor.execute('SELECT * FROM "%s"' % name)
+        rows = cursor.fetchall()
+        if rows:
+            target_cursor.executemany('INSERT INTO "%s" VALUES (%s)' % (name, ', '.join(['%s'] * len(rows[0]))),
+                                      rows)
+
+
+class TestReplicaReads(TestCase):
+    alias = 'poll_test_replica'
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('copies the database with sqlite_master')
+        settings.DATABASES[self.alias] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        self.old_report_database, replica.REPORT_DATABASE = replica.REPORT_DATABASE, self.alias
+        self.old_routers = getattr(settings, 'DATABASE_ROUTERS', [])
+        settings.DATABASE_ROUTERS = list(self.old_routers) + [replica.ROUTER_PATH]
+        self.router = ReportRouter()
+        router.routers.append(self.router)
+
+        user = User.objects.create(username='replica', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='replica poll', question='are you replicated?', user=user,
+                                        type=Poll.TYPE_TEXT)
+        self.poll.add_yesno_categories()
+        backend = Backend.objects.create(name='replica')
+        contact = Contact.objects.create(name='replica')
+        self.connection = Connection.objects.create(identity='0794000051', backend=backend, contact=contact)
+        self.answer('yes')
+        copy_sqlite_database(connection, connections[self.alias])
+
+        self.req = RequestFactory().get('/')
+        self.req.session = {}
+
+    def tearDown(self):
+        router.routers.remove(self.router)
+        settings.DATABASE_ROUTERS = self.old_routers
+        replica.REPORT_DATABASE = self.old_report_database
+        connections[self.alias].close()
+        del settings.DATABASES[self.alias]
+
+    def answer(self, text):
+        message = Message.objects.create(connection=self.connection, text=text, direction='I', status='H')
+        self.poll.process_response(message)
+
+    def counts(self, response):
+        return [row['value'] for row in simplejson.loads(response.content)['data']]
+
+    def test_lagging_replica_report_is_not_cached(self):
+        self.answer('yes')
+
+        lagging = stats(self.req, str(self.poll.pk))
+        self.assertEqual(self.counts(lagging), [1])
+        self.assertFalse(lagging.has_header('ETag'))
+
+        pin_to_primary(self.req)
+        current = stats(self.req, str(self.poll.pk))
+        self.assertEqual(self.counts(current), [2])
+        self.assertTrue(current.has_header('ETag'))
@@ -0,0 +1,52 @@
+from django.core.cache.backends.dummy import DummyCache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.contrib.auth.models import User
+
+from poll import cache_versions
+from poll.models import Poll, Response
+from poll.report_cache import get_data_version
+from poll.views import stats
+
+
+class TestReportCache(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='report_cache', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='cached poll', question='are you cached?', user=self.user,
+                                        type=Poll.TYPE_TEXT)
+        self.poll.add_yesno_categories()
+        self.factory = RequestFactory()
+
+    def test_data_version_bumps_on_response_and_category_changes(self):
+        version = get_data_version(self.poll.pk)
+
+        Response.objects.create(poll=self.poll)
+        self.assertNotEqual(get_data_version(self.poll.pk), version)
+
+        version = get_data_version(self.poll.pk)
+        self.poll.categories.create(name='maybe')
+        self.assertNotEqual(get_data_version(self.poll.pk), version)
+
+    def test_unchanged_data_returns_not_modified(self):
+        first = stats(self.factory.get('/'), poll_id=str(self.poll.pk))
+        self.assertEqual(first.status_code, 200)
+        etag = first['ETag']
+
+        second = stats(self.factory.get('/', HTTP_IF_NONE_MATCH=etag), poll_id=str(self.poll.pk))
+        self.assertEqual(second.status_code, 304)
+
+        Response.objects.create(poll=self.poll)
+        third = stats(self.factory.get('/', HTTP_IF_NONE_MATCH=etag), poll_id=str(self.poll.pk))
+        self.assertEqual(third.status_code, 200)
+        self.assertNotEqual(third['ETag'], etag)
+
+    def test_no_version_means_no_etag(self):
+        real_cache, cache_versions.cache = cache_versions.cache, DummyCache('dummy', {})
+        try:
+            self.assertEqual(get_data_version(self.poll.pk), None)
+            response = stats(self.factory.get('/'), poll_id=str(self.poll.pk))
+        finally:
+            cache_versions.cache = real_cache
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
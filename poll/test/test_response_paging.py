@@ -0,0 +1,36 @@
+import datetime
+
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+from poll.models import Poll, Response
+from poll.views import get_response_page
+
+
+class TestResponsePaging(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='pager', email='foo@foo.com')
+        self.poll = Poll.objects.create(name='paged poll', question='are you paged?', user=self.user,
+                                        type=Poll.TYPE_TEXT)
+        # several responses share a date, so the pk tiebreak matters
+        date = datetime.datetime(2013, 5, 28, 12, 0)
+        for i in range(7):
+            resp = Response.objects.create(poll=self.poll)
+            Response.objects.filter(pk=resp.pk).update(date=date + datetime.timedelta(minutes=i // 3))
+
+    def test_pages_cover_every_response_once(self):
+        seen = []
+        page, cursor = get_response_page(self.poll, page_size=3)
+        seen.extend(page)
+        while cursor:
+            page, cursor = get_response_page(self.poll, before=cursor, page_size=3)
+            seen.extend(page)
+
+        expected = list(self.poll.responses.order_by('-date', '-pk'))
+        self.assertEqual([r.pk for r in seen], [r.pk for r in expected])
+
+    def test_bad_cursor_starts_from_the_top(self):
+        page, cursor = get_response_page(self.poll, before='garbage', page_size=10)
+        self.assertEqual(len(page), 7)
+        self.assertEqual(cursor, None)
@@ -4,6 +4,9 @@ from . import views
 urlpatterns = patterns('',
     url(r"^$", views.polls, name="polls"),
     url(r"^(\d+)/submissions.csv$", views.responses_as_csv),    
+    url(r"^(?P<poll_id>\d+)/export/$", views.request_export, name="poll-export"),
+    url(r"^export/(?P<job_id>\d+)/$", views.export_status, name="poll-export-status"),
+    url(r"^export/(?P<job_id>\d+)/download/$", views.download_export, name="poll-export-download"),
     url(r"^new/$", views.new_poll),
     url(r"^(\d+)/responses/$", views.view_responses, name="poll-responses"),
     url(r"^(?P<poll_id>\d+)/responses/module/$", views.view_responses,  {'as_module':True}, name="poll-responses-module"),    
@@ -21,6 +24,10 @@ urlpatterns = patterns('',
     url(r"^responses/(?P<poll_id>\d+)/stats/(?P<location_id>\d+)/$", views.stats, name="poll-stats"),
     url(r"^responses/(?P<poll_id>\d+)/agestats/$", views.age_stats, name="poll-age-stats"),
     url(r"^responses/(?P<poll_id>\d+)/genderstats/$", views.gender_stats, name="poll-gender-stats"),
+    url(r"^responses/(?P<poll_id>\d+)/demographicstats/$", views.demographic_stats, name="poll-demographic-stats"),
+    url(r"^responses/(?P<poll_id>\d+)/timeseries/$", views.timeseries, name="poll-timeseries"),
+    url(r"^compare/$", views.compare_polls, name="poll-compare"),
+    url(r"^responses/(?P<poll_id>\d+)/map/(?P<level>\d+)/$", views.map_layer, name="poll-map-layer"),
     url(r"^responses/(?P<poll_id>\d+)/numeric/$", views.number_details),
     url(r"^(\d+)/view/$", views.view_poll),
     url(r"^(\d+)/details/$", views.view_poll_details),
@@ -1,13 +1,22 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import datetime
+
 from django.db import transaction
-from django.db.models import Q, Count
-from django.views.decorators.http import require_GET
+from django.db.models import Q
+from django.views.decorators.http import require_GET, require_POST
 from django.template import RequestContext
+from django.template.loader import render_to_string
 from django.shortcuts import redirect, get_object_or_404, \
     render_to_response
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.core.servers.basehttp import FileWrapper
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # older Django streams any iterator handed to a plain HttpResponse
+    StreamingHttpResponse = HttpResponse
 from django.contrib.sites.models import Site
 from django.contrib.auth.decorators import login_required, \
     permission_required
@@ -15,13 +24,18 @@ from django.utils import simplejson
 from django.utils.safestring import mark_safe
 from rapidsms_httprouter.router import get_router
 from rapidsms.messages.outgoing import OutgoingMessage
-from models import Response,ResponseCategory
+from models import Response,ResponseCategory,ExportJob,ResultSnapshot
 from rapidsms.contrib.locations.models import Location
 from rapidsms.models import Connection, Backend
 from eav.models import Attribute
 from django.core.urlresolvers import reverse
 from django.views.decorators.cache import cache_control, never_cache
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.conf import settings
+from report_cache import cached_report, etag_matches
+from replica import report_reads, pins_primary, report_database
+from export import stream_csv
+from map_layers import get_map_layer, decompress
 
 
 from forms import *
@@ -34,21 +48,74 @@ from forms import *
 def responses_as_csv(req, pk):
     poll = get_object_or_404(Poll, pk=pk)
 
-    responses = poll.responses.all().order_by('-pk')
-
-    resp = render_to_response('polls/responses.csv', {'responses'
-                              : responses}, mimetype='text/csv',
-                              context_instance=RequestContext(req))
+    resp = StreamingHttpResponse(stream_csv(poll, using=report_database(req)), content_type='text/csv')
     resp['Content-Disposition'] = 'attachment;filename="%s.csv"' \
         % poll.name
     return resp
 
 
+def _archived_poll_response(poll):
+    """
+    For the reports an archived poll's snapshot doesn't cover, which would
+    otherwise come back empty.
+    """
+    return HttpResponse("Poll '%s' is archived: only its exports and its top-level reports are available until "
+                        "it is restored with the restore_poll command." % poll.name,
+                        status=409, content_type='text/plain')
+
+
+def _export_job_response(job):
+    data = {
+        'id': job.pk,
+        'status': job.get_status_display(),
+        'progress': job.progress,
+        'rows_written': job.rows_written,
+        'total_rows': job.total_rows,
+        'download_url': None,
+    }
+    if job.is_done:
+        data['download_url'] = reverse('poll-export-download', args=[job.pk])
+    return HttpResponse(simplejson.dumps(data), content_type='application/json')
+
+
+@login_required
+@require_POST
+def request_export(req, poll_id):
+    poll = get_object_or_404(Poll, pk=poll_id)
+    format = req.POST.get('format', ExportJob.FORMAT_CSV)
+    if format not in dict(ExportJob.FORMAT_CHOICES):
+        return HttpResponse(status=400)
+    job = ExportJob.request(poll, format=format, user=req.user)
+    return _export_job_response(job)
+
+
+@login_required
+@require_GET
+def export_status(req, job_id):
+    job = get_object_or_404(ExportJob, pk=job_id)
+    return _export_job_response(job)
+
+
+@login_required
+@require_GET
+def download_export(req, job_id):
+    job = get_object_or_404(ExportJob, pk=job_id)
+    if not job.is_done:
+        raise Http404
+    try:
+        export_file = open(job.file_path, 'rb')
+    except IOError:
+        raise Http404
+    resp = HttpResponse(FileWrapper(export_file), content_type='application/x-gzip')
+    resp['Content-Disposition'] = 'attachment;filename="%s"' \
+        % job.get_filename()
+    return resp
+
+
 @require_GET
 @login_required
 def polls(req):
-    polls = Poll.objects.annotate(Count('responses'
-                                  )).order_by('start_date')
+    polls = Poll.objects.order_by('start_date')
     breadcrumbs = (('Polls', ''), )
     return render_to_response('polls/poll_index.html', {'polls': polls,
                               'breadcrumbs': breadcrumbs},
@@ -171,6 +238,7 @@ def view_poll(req, poll_id):
 
 
 @login_required
+@report_reads
 def view_report(
     req,
     poll_id,
@@ -180,10 +248,8 @@ def view_report(
 
     template = 'polls/poll_report.html'
     poll = get_object_or_404(Poll, pk=poll_id)
-    try:
-        response_rate = poll.responses.distinct().count() * 100.0 \
-            / poll.contacts.distinct().count()
-    except ZeroDivisionError:
+    response_rate = poll.get_response_rate()
+    if response_rate is None:
         response_rate = 'N/A'
     if as_module:
         if poll.type == Poll.TYPE_TEXT:
@@ -195,6 +261,8 @@ def view_report(
     is_text_poll = True
     if Poll.TYPE_CHOICES[poll.type]['db_type'] == Attribute.TYPE_TEXT:
         report_function = poll.responses_by_category
+        if req.GET.get('approximate'):
+            report_function = poll.approximate_responses_by_category
     elif Poll.TYPE_CHOICES[poll.type]['db_type'] \
         == Attribute.TYPE_FLOAT:
         report_function = poll.get_numeric_report_data
@@ -208,9 +276,25 @@ def view_report(
                 ).distinct()
 
 
+    location_response_rates = []
+    if req.GET.get('rates_by_location'):
+        for location in locations:
+            location_response_rates += poll.response_rates_by_location(location)
+
+    location_reports = {}
+    snapshot = poll.get_result_snapshot()
+    if snapshot is not None:
+        location_reports = snapshot['location_reports']
+    if poll.is_archived() and not req.GET.get('approximate') \
+            and any(str(location.pk) not in location_reports for location in locations):
+        return _archived_poll_response(poll)
+
     results = []
     for location in locations:
-        report = report_function(location=location, for_map=False)
+        if str(location.pk) in location_reports:
+            report = location_reports[str(location.pk)]
+        else:
+            report = report_function(location=location, for_map=False)
         if len(report):
             if is_text_poll:
                 offset = 0
@@ -225,7 +309,7 @@ def view_report(
                     data = []
                     total = 0.0
 
-                    for c in poll.categories.order_by('name'):
+                    for c in poll.categories.filter(deleted=False).order_by('name'):
                         if offset < len(report) \
                             and report[offset]['location_id'] \
                             == row['location_id'] \
@@ -264,9 +348,11 @@ def view_report(
     context = {
         'poll': poll,
         'breadcrumbs': breadcrumbs,
-        'categories': poll.categories.order_by('name'),
+        'categories': poll.categories.filter(deleted=False).order_by('name'),
         'report_rows': results,
         'response_rate': response_rate,
+        'total_responses': poll.response_count,
+        'location_response_rates': location_response_rates,
         }
 
     if poll.type != Poll.TYPE_TEXT and poll.type != Poll.TYPE_NUMERIC:
@@ -282,8 +368,7 @@ def view_report(
 @login_required
 @cache_control(no_cache=True, max_age=0)
 def view_poll_details(req, form_id):
-    poll = get_object_or_404(Poll.objects.annotate(Count('contacts')),
-                             pk=form_id)
+    poll = get_object_or_404(Poll, pk=form_id)
     return render_to_response('polls/poll_details.html', {'poll'
                               : poll},
                               context_instance=RequestContext(req))
@@ -291,6 +376,7 @@ def view_poll_details(req, form_id):
 
 @login_required
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def edit_poll(req, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     categories = Category.objects.filter(poll=poll)
@@ -316,11 +402,58 @@ def edit_poll(req, poll_id):
         }, context_instance=RequestContext(req))
 
 
+RESPONSES_PAGE_SIZE = getattr(settings, 'POLL_RESPONSES_PAGE_SIZE', 50)
+RESPONSES_MAX_PAGE_SIZE = getattr(settings, 'POLL_RESPONSES_MAX_PAGE_SIZE', 500)
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _encode_cursor(response):
+    return '%s_%d' % (response.date.strftime(CURSOR_DATE_FORMAT), response.pk)
+
+
+def _decode_cursor(cursor):
+    try:
+        date, pk = cursor.rsplit('_', 1)
+        return (datetime.datetime.strptime(date, CURSOR_DATE_FORMAT), int(pk))
+    except ValueError:
+        return None
+
+
+def get_response_page(poll, before=None, page_size=RESPONSES_PAGE_SIZE):
+    """
+    Returns one page of a poll's responses, newest first, and the cursor
+    for the next page (or None).  Pages are keyed on (date, pk) rather than
+    an offset, so any page costs the same regardless of how deep it is.
+    """
+    responses = poll.responses.select_related('poll', 'message__connection__contact') \
+        .prefetch_related('categories__category') \
+        .order_by('-date', '-pk')
+    position = _decode_cursor(before) if before else None
+    if position:
+        date, pk = position
+        responses = responses.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))
+
+    # fetch one extra row to know whether there's another page
+    page = list(responses[:page_size + 1])
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = _encode_cursor(page[-1])
+    Response.prefetch_values(page)
+    return page, next_cursor
+
+
 @login_required
 def view_responses(req, poll_id, as_module=False):
     poll = get_object_or_404(Poll, pk=poll_id)
+    if poll.is_archived():
+        return _archived_poll_response(poll)
 
-    responses = poll.responses.all().order_by('-date')
+    try:
+        page_size = min(int(req.GET.get('page_size', RESPONSES_PAGE_SIZE)), RESPONSES_MAX_PAGE_SIZE)
+    except ValueError:
+        page_size = RESPONSES_PAGE_SIZE
+    responses, next_cursor = get_response_page(poll, before=req.GET.get('before'), page_size=max(page_size, 1))
 
     breadcrumbs = (('Polls', reverse('polls')), ('Responses', ''))
 
@@ -329,48 +462,192 @@ def view_responses(req, poll_id, as_module=False):
         template = 'polls/response_table.html'
 
     typedef = Poll.TYPE_CHOICES[poll.type]
-    return render_to_response(template, {
+    context = {
         'poll': poll,
         'responses': responses,
+        'next_cursor': next_cursor,
+        'page_size': page_size,
         'breadcrumbs': breadcrumbs,
         'columns': typedef['report_columns'],
         'db_type': typedef['db_type'],
         'row_template': typedef['view_template'],
-        }, context_instance=RequestContext(req))
+        }
+
+    if req.GET.get('format') == 'json':
+        # for infinite scroll: the rendered rows plus the cursor to fetch next
+        rows = render_to_string('polls/response_rows.html', context,
+                                context_instance=RequestContext(req))
+        return HttpResponse(simplejson.dumps({'rows': rows, 'count': len(responses),
+                                              'next': next_cursor}),
+                            content_type='application/json')
 
+    return render_to_response(template, context, context_instance=RequestContext(req))
 
+
+@cached_report('stats')
+@report_reads
 def stats(req, poll_id, location_id=None):
     poll = get_object_or_404(Poll, pk=poll_id)
     location = None
     if location_id:
         location = get_object_or_404(Location, pk=location_id)
-    json_response_data = {}
+    snapshot = poll.get_result_snapshot() or {}
+    if location is None and 'categories' in snapshot:
+        data = snapshot['categories']
+    elif req.GET.get('approximate'):
+        data = poll.approximate_responses_by_category(location, for_map=True)
+    elif poll.is_archived():
+        # the snapshot has the report of each root location, less the map points
+        rows = snapshot.get('location_reports', {}).get(str(location.pk)) if location else None
+        if rows is None:
+            return _archived_poll_response(poll)
+        points = Poll._report_points([row['location_id'] for row in rows])
+        data = [dict(row, lat=points[row['location_id']][0], lon=points[row['location_id']][1])
+                for row in rows if row['location_id'] in points]
+    else:
+        data = list(poll.responses_by_category(location))
     json_response_data = {'layer_title': 'Survey:%s' % poll.name,
                           'layer_type': 'categorized',
-                          'data': list(poll.responses_by_category(location))}
+                          'data': data}
     return HttpResponse(mark_safe(simplejson.dumps(json_response_data)))
 
+@report_reads
+def map_layer(req, poll_id, level):
+    """
+    GeoJSON layer of a poll's categorized results at a location level,
+    served pre-compressed to clients that accept gzip.
+    """
+    poll = get_object_or_404(Poll, pk=poll_id)
+    version, payload = get_map_layer(poll, int(level))
+    etag = '"map-%s-%s-%s"' % (poll.pk, level, version) if version is not None else None
+
+    if etag and etag_matches(req, etag):
+        response = HttpResponseNotModified()
+    elif 'gzip' in req.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(payload, content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(decompress(payload), content_type='application/json')
+    if etag:
+        response['ETag'] = etag
+    patch_vary_headers(response, ['Accept-Encoding'])
+    patch_cache_control(response, must_revalidate=True, max_age=0)
+    return response
+
+@cached_report('gender_stats')
+@report_reads
 def gender_stats(req, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     gender = req.GET.get('gender', '')
+    snapshot = poll.get_result_snapshot()
+    if snapshot is not None and gender.upper() in snapshot.get('gender', {}):
+        return HttpResponse(mark_safe(simplejson.dumps(snapshot['gender'][gender.upper()])))
+    if poll.is_archived():
+        return _archived_poll_response(poll)
     try:
         filtered_data = poll.responses_by_gender(gender)
     except AssertionError:
         filtered_data = []
     return HttpResponse(mark_safe(simplejson.dumps(filtered_data)))
 
+@cached_report('age_stats')
+@report_reads
 def age_stats(req, poll_id):
     lower = int(req.GET.get('lower',0))
     upper = int(req.GET.get('upper',100))
     poll = get_object_or_404(Poll, pk=poll_id)
+    if poll.is_archived():
+        return _archived_poll_response(poll)
     return HttpResponse(mark_safe(simplejson.dumps(poll.responses_by_age(lower,upper))))
 
 
+@cached_report('demographic_stats')
+@report_reads
+def demographic_stats(req, poll_id):
+    poll = get_object_or_404(Poll, pk=poll_id)
+    try:
+        edges = ResultSnapshot.AGE_EDGES
+        if req.GET.get('edges'):
+            edges = [int(e) for e in req.GET['edges'].split(',')]
+    except ValueError:
+        return HttpResponse(status=400)
+    snapshot = poll.get_result_snapshot()
+    if snapshot is not None and edges == ResultSnapshot.AGE_EDGES:
+        return HttpResponse(mark_safe(simplejson.dumps(snapshot['demographics'])))
+    if poll.is_archived():
+        return _archived_poll_response(poll)
+    return HttpResponse(mark_safe(simplejson.dumps(poll.responses_by_demographics(edges))))
+
+
+TIMESERIES_DATE_FORMAT = '%Y-%m-%dT%H'
+
+
+@cached_report('timeseries')
+@report_reads
+def timeseries(req, poll_id):
+    poll = get_object_or_404(Poll, pk=poll_id)
+    try:
+        start = end = None
+        if req.GET.get('start'):
+            start = datetime.datetime.strptime(req.GET['start'], TIMESERIES_DATE_FORMAT)
+        if req.GET.get('end'):
+            end = datetime.datetime.strptime(req.GET['end'], TIMESERIES_DATE_FORMAT)
+    except ValueError:
+        return HttpResponse(status=400)
+    category = None
+    if req.GET.get('category'):
+        category = get_object_or_404(Category, pk=req.GET['category'], poll=poll)
+    location = None
+    if req.GET.get('location'):
+        location = get_object_or_404(Location, pk=req.GET['location'])
+
+    def serialize(series):
+        return [(hour.strftime(TIMESERIES_DATE_FORMAT), count) for hour, count in series]
+
+    if req.GET.get('by_category'):
+        series = poll.response_timeseries(start, end, location=location, by_category=True)
+        data = dict((name, serialize(s)) for name, s in series.items())
+    else:
+        data = serialize(poll.response_timeseries(start, end, category=category, location=location))
+    return HttpResponse(mark_safe(simplejson.dumps({'poll': poll.pk, 'series': data})))
+
+
+@cached_report('number_details')
+@report_reads
 def number_details(req, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
+    snapshot = poll.get_result_snapshot()
+    if snapshot is not None and 'numeric_details' in snapshot:
+        return HttpResponse(mark_safe(simplejson.dumps(snapshot['numeric_details'])))
+    if poll.is_archived():
+        return _archived_poll_response(poll)
     return HttpResponse(mark_safe(simplejson.dumps(list(poll.get_numeric_detailed_data()))))
 
 
+# upper bound on the polls compared in one request
+COMPARE_MAX_POLLS = 20
+
+
+@login_required
+@report_reads
+def compare_polls(req):
+    """
+    Side-by-side results for several polls at one location level, e.g.
+    ?polls=3,7,9&level=2
+    """
+    try:
+        poll_ids = [int(pk) for pk in req.GET.get('polls', '').split(',') if pk.strip()]
+        level = int(req.GET.get('level', 1))
+    except ValueError:
+        return HttpResponse(status=400)
+    if not poll_ids or len(poll_ids) > COMPARE_MAX_POLLS:
+        return HttpResponse(status=400)
+    for poll in Poll.objects.filter(pk__in=poll_ids).exclude(archive=None):
+        return _archived_poll_response(poll)
+    report = Poll.comparison_report(poll_ids, level)
+    return HttpResponse(mark_safe(simplejson.dumps(report)), content_type='application/json')
+
+
 def _get_response_edit_form(response, data=None):
     typedef = Poll.TYPE_CHOICES[response.poll.type]
     form = None
@@ -421,30 +698,31 @@ def _get_response_edit_form(response, data=None):
         if not typedef['edit_form']:
             value = response.message.text
         elif typedef['db_type'] == Attribute.TYPE_TEXT:
-            value = response.eav.poll_text_value
+            value = response.poll_text_value
         elif typedef['db_type'] == Attribute.TYPE_FLOAT:
-            value = response.eav.poll_number_value
+            value = response.poll_number_value
         elif typedef['db_type'] == Attribute.TYPE_OBJECT:
-            value = response.eav.poll_location_value
+            value = response.poll_location_value
         return form(response=response, initial={'value': value})
 
 
 @login_required
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def apply_response(req, response_id):
     response = get_object_or_404(Response, pk=response_id)
     poll = response.poll
     if poll.type == Poll.TYPE_REGISTRATION:
         try:
             response.message.connection.contact.name = \
-                response.eav.poll_text_value
+                response.poll_text_value
             response.message.connection.contact.save()
         except AttributeError:
             pass
     elif poll.type == Poll.TYPE_LOCATION:
         try:
             response.message.connection.contact.reporting_location = \
-                response.eav.poll_location_value
+                response.poll_location_value
             response.message.connection.contact.save()
         except AttributeError:
             pass
@@ -453,20 +731,21 @@ def apply_response(req, response_id):
 
 
 @login_required
+@pins_primary
 def apply_all(req, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     for response in Response.objects.filter(poll=poll):
         if poll.type == Poll.TYPE_REGISTRATION:
             try:
                 response.message.connection.contact.name = \
-                    response.eav.poll_text_value
+                    response.poll_text_value
                 response.message.connection.contact.save()
             except AttributeError:
                 pass
         elif poll.type == Poll.TYPE_LOCATION:
             try:
                 response.message.connection.contact.reporting_location = \
-                    response.eav.poll_location_value
+                    response.poll_location_value
                 response.message.connection.contact.save()
             except AttributeError:
                 pass
@@ -476,6 +755,7 @@ def apply_all(req, poll_id):
 @login_required
 @transaction.commit_on_success
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def edit_response(req, response_id):
     response = get_object_or_404(Response, pk=response_id)
     poll = response.poll
@@ -493,13 +773,13 @@ def edit_response(req, response_id):
 
             if 'value' in form.cleaned_data:
                 if db_type == Attribute.TYPE_FLOAT:
-                    response.eav.poll_number_value = \
+                    response.poll_number_value = \
                         form.cleaned_data['value']
                 elif db_type == Attribute.TYPE_OBJECT:
-                    response.eav.poll_location_value = \
+                    response.poll_location_value = \
                         form.cleaned_data['value']
                 elif db_type == Attibute.TYPE_TEXT:
-                    response.eav.poll_text_value = \
+                    response.poll_text_value = \
                         form.cleaned_data['value']
             response.save()
             return render_to_response(view_template, {'response'
@@ -530,6 +810,7 @@ def view_response(req, response_id):
 
 @login_required
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def delete_response(req, response_id):
     response = get_object_or_404(Response, pk=response_id)
     poll = response.poll
@@ -554,6 +835,7 @@ def view_category(req, poll_id, category_id):
 @login_required
 @transaction.commit_on_success
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def edit_category(req, poll_id, category_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     category = get_object_or_404(Category, pk=category_id)
@@ -584,6 +866,7 @@ def edit_category(req, poll_id, category_id):
 
 @login_required
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def add_category(req, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     form = CategoryForm()
@@ -614,10 +897,11 @@ def add_category(req, poll_id):
 @login_required
 @permission_required('poll.can_edit_poll')
 @never_cache
+@pins_primary
 def delete_poll(req, poll_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     if req.method == 'POST':
-        poll.delete()
+        poll.soft_delete()
 
     return HttpResponse(status=200)
 
@@ -636,6 +920,7 @@ def start_poll(req, poll_id):
 
 @login_required
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def end_poll(req, poll_id):
     poll = Poll.objects.get(pk=poll_id)
     if req.method == 'POST':
@@ -648,17 +933,19 @@ def end_poll(req, poll_id):
 
 @login_required
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def delete_category(req, poll_id, category_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     category = get_object_or_404(Category, pk=category_id)
 
     if req.method == 'POST':
-        category.delete()
+        category.soft_delete()
     return HttpResponse(status=200)
 
 
 @login_required
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def edit_rule(
     req,
     poll_id,
@@ -700,6 +987,7 @@ def edit_rule(
 
 @login_required
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def add_rule(req, poll_id, category_id):
     poll = get_object_or_404(Poll, pk=poll_id)
     if poll.type != Poll.TYPE_TEXT:
@@ -766,6 +1054,7 @@ def view_rules(req, poll_id, category_id):
 @login_required
 @transaction.commit_on_success
 @permission_required('poll.can_edit_poll')
+@pins_primary
 def delete_rule(
     req,
     poll_id,
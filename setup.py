@@ -7,6 +7,11 @@ setup(
 
     install_requires = ["rapidsms", 'django-uni-form', 'django-eav'],
 
+    extras_require = {
+        # the in-memory columnar report engine
+        'columnar': ['numpy'],
+    },
+
     dependency_links = [
         "http://github.com/mvpdev/django-eav/tarball/master#egg=django-eav",
     ],